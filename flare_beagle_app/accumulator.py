@@ -0,0 +1,119 @@
+import io
+from collections import deque
+from datetime import datetime, timedelta
+import cv2
+import numpy as np
+
+
+class ContourAccumulator:
+    # Накопление масок кадров: sum_contour - OR по всем кадрам с начала
+    # события. Если задано окно (число кадров или timedelta), дополнительно
+    # хранятся упакованные маски кадров окна и счётчик попаданий по пикселям,
+    # так что OR и число кадров в окне обновляются за O(1) кадров на шаг.
+
+    def __init__(self, shape=(4096, 4096), window=None):
+        self.shape = tuple(shape)
+        self.window = window
+        self.sum_contour = np.zeros(self.shape, dtype='uint8')
+        self.counts = np.zeros(self.shape, dtype='uint16') if window is not None else None
+        self.ring = deque()
+        self.frames = 0
+        self.t_last = None
+
+    def update(self, mask, t=None):
+        # при окне-timedelta кадры выбывают по времени, так что t обязательно
+        if t is None and isinstance(self.window, timedelta):
+            raise ValueError('a time window needs the frame time t')
+        cv2.bitwise_or(mask, self.sum_contour, dst=self.sum_contour)
+        self.frames += 1
+        self.t_last = t
+
+        if self.window is not None:
+            hit = mask > 0
+            np.add(self.counts, hit, out=self.counts, casting='unsafe')
+            self.ring.append((t, np.packbits(hit)))
+            self._expire(t)
+
+    def _expired(self, t):
+        if isinstance(self.window, timedelta):
+            return t - self.ring[0][0] > self.window
+        return len(self.ring) > self.window
+
+    def _expire(self, t):
+        while self.ring and self._expired(t):
+            _, packed = self.ring.popleft()
+            hit = np.unpackbits(packed, count=self.counts.size).reshape(self.shape)
+            np.subtract(self.counts, hit, out=self.counts, casting='unsafe')
+
+    def window_or(self):
+        # None, если окно не задано: OR по всем кадрам - sum_contour
+        if self.window is None:
+            return None
+        return np.where(self.counts > 0, 255, 0).astype('uint8')
+
+    def snapshot(self):
+        snapshot = {'or': self.sum_contour.copy(), 'frames': self.frames, 't_last': self.t_last}
+        if self.window is not None:
+            snapshot['window_or'] = self.window_or()
+            snapshot['count'] = self.counts.copy()
+            snapshot['window_frames'] = len(self.ring)
+        return snapshot
+
+    # ---- контрольные точки ----
+
+    def _window_meta(self):
+        if isinstance(self.window, timedelta):
+            return 'seconds', self.window.total_seconds()
+        if self.window is None:
+            return 'none', 0
+        return 'frames', self.window
+
+    def save(self, file):
+        # file - путь или файловый объект
+        kind, value = self._window_meta()
+        times = [t.isoformat() if t is not None else '' for t, _ in self.ring]
+        packed = np.stack([p for _, p in self.ring]) if self.ring else np.zeros((0, 0), 'uint8')
+        np.savez_compressed(file,
+                            shape=np.array(self.shape),
+                            window=np.array([kind, str(value)]),
+                            frames=np.array(self.frames),
+                            t_last=np.array(self.t_last.isoformat() if self.t_last is not None else ''),
+                            sum_contour=self.sum_contour,
+                            counts=self.counts if self.counts is not None else np.zeros(0, 'uint16'),
+                            times=np.array(times),
+                            packed=packed)
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as data:
+            kind, value = data['window']
+            window = None
+            if kind == 'frames':
+                window = int(float(value))
+            elif kind == 'seconds':
+                window = timedelta(seconds=float(value))
+            acc = cls(tuple(data['shape']), window)
+
+            acc.frames = int(data['frames'])
+            t_last = str(data['t_last'])
+            acc.t_last = datetime.fromisoformat(t_last) if t_last else None
+            acc.sum_contour[:] = data['sum_contour']
+            if acc.counts is not None:
+                acc.counts[:] = data['counts']
+                for t, packed in zip(data['times'], data['packed']):
+                    acc.ring.append((datetime.fromisoformat(str(t)) if t else None, packed))
+
+        return acc
+
+    def save_gridfs(self, fs, name):
+        # fs - gridfs.GridFS; хранится только последняя версия
+        buf = io.BytesIO()
+        self.save(buf)
+        file_id = fs.put(buf.getvalue(), filename=name, frames=self.frames, t_last=self.t_last)
+        for old in fs.find({'filename': name, '_id': {'$ne': file_id}}):
+            fs.delete(old._id)
+        return file_id
+
+    @classmethod
+    def load_gridfs(cls, fs, name):
+        return cls.load(io.BytesIO(fs.get_last_version(name).read()))
@@ -0,0 +1,131 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from accumulator import ContourAccumulator
+from fits_io import read_frame, read_header
+from image_processing import Preprocessor, find_flare, smooth_thresh
+
+
+# Пакетная обработка серии кадров на пуле процессов. Кадры читаются самими
+# воркерами, маски и разности лежат в общем memmap-файле (в /dev/shm, если
+# там хватает места, иначе во временном каталоге на диске) и не пиклются;
+# порядок важен только для свёртки в родителе.
+
+# потолок порции по умолчанию: memmap занимает 2 * (chunk + 1) кадров
+MAX_CHUNK = 16
+# запас свободного места в /dev/shm сверх размера memmap
+SHM_HEADROOM = 1.25
+
+_worker = {}
+
+
+def _init_worker(path, shape, slots):
+    _worker['frames'] = np.memmap(path, dtype=np.uint8, mode='r+', shape=(2, slots) + shape)
+    _worker['preprocessor'] = Preprocessor()
+
+
+def _preprocess_frame(path, slot, smooth):
+    header, data = read_frame(path)
+    thresh = _worker['frames'][0, slot]
+    _worker['preprocessor'].process(data, header, out=thresh)
+    if smooth:
+        thresh[:] = smooth_thresh(thresh)
+
+    return slot
+
+
+def _find_flare(slot_one, slot_two, diff_slot):
+    frames, diffs = _worker['frames']
+    spots, diff = find_flare(frames[slot_one], frames[slot_two])
+    diffs[diff_slot] = diff
+
+    return spots
+
+
+def memmap_dir(nbytes, shm_dir='/dev/shm'):
+    # /dev/shm только если в нём есть место: переполненный tmpfs (в Docker по
+    # умолчанию 64 МБ) роняет воркеров по SIGBUS, а не ошибкой Python.
+    # None - каталог tempfile по умолчанию
+    if not os.path.isdir(shm_dir):
+        return None
+    stat = os.statvfs(shm_dir)
+    if stat.f_bavail * stat.f_frsize < nbytes * SHM_HEADROOM:
+        return None
+    return shm_dir
+
+
+def frame_shape(path):
+    header = read_header(path)
+    return header['naxis2'], header['naxis1']
+
+
+class FramePool:
+    # пул процессов и общий memmap на slots масок и slots разностей
+
+    def __init__(self, shape, workers=None, chunk=None):
+        self.workers = workers or os.cpu_count()
+        self.chunk = chunk or min(2 * self.workers, MAX_CHUNK)
+        # +1 слот под последний кадр предыдущей порции
+        self.slots = self.chunk + 1
+        self.shape = tuple(shape)
+
+        nbytes = 2 * self.slots * int(np.prod(self.shape))
+        self.file = tempfile.NamedTemporaryFile(prefix='flare_beagle_', dir=memmap_dir(nbytes))
+        self.frames = np.memmap(self.file.name, dtype=np.uint8, mode='w+',
+                                shape=(2, self.slots) + self.shape)
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(self.file.name, self.shape, self.slots))
+
+    def close(self):
+        self.pool.shutdown()
+        del self.frames
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunks(self, files):
+        for start in range(0, len(files), self.chunk):
+            yield start, files[start:start + self.chunk]
+
+    def preprocess(self, start, paths, smooth=False):
+        futures = [self.pool.submit(_preprocess_frame, path, (start + k) % self.slots, smooth)
+                   for k, path in enumerate(paths)]
+        return [f.result() for f in futures]
+
+
+def detect_flare_parallel(files, workers=None, chunk=None):
+    # то же, что detect_flare_series(files), но кадры обрабатываются параллельно
+    files = list(files)
+    if len(files) < 2:
+        return
+
+    with FramePool(frame_shape(files[0]), workers, chunk) as fp:
+        for start, paths in fp.chunks(files):
+            fp.preprocess(start, paths)
+
+            pairs = [i for i in range(start, start + len(paths)) if i > 0]
+            futures = [fp.pool.submit(_find_flare, (i - 1) % fp.slots, i % fp.slots, i % fp.slots)
+                       for i in pairs]
+            for i, future in zip(pairs, futures):
+                yield future.result(), fp.frames[1, i % fp.slots].copy()
+
+
+def accum_parallel(files, spots, workers=None, chunk=None):
+    # то же, что accum(files, spots): маски строятся параллельно,
+    # OR-свёртка идёт в порядке кадров
+    files = list(files)
+    if len(files) == 0:
+        return np.zeros((4096, 4096), dtype='uint8')
+
+    acc = ContourAccumulator(frame_shape(files[0]))
+    with FramePool(acc.shape, workers, chunk) as fp:
+        for start, paths in fp.chunks(files):
+            for slot in fp.preprocess(start, paths, smooth=True):
+                acc.update(fp.frames[0, slot])
+
+    return acc.sum_contour
@@ -0,0 +1,85 @@
+import time
+import cv2
+import numpy as np
+from image_processing import dist, get_cnt_piece, get_union_points
+
+
+# прежние реализации на чистом python - для сравнения скорости и результата
+def get_cnt_piece_loop(cnt, start, end):
+    piece = []
+    ids = []
+    if (start - end) < 0:
+        for p in range(start, 0, -1):
+            piece.append(cnt[p])
+            ids.append(p)
+        for p in range(0, end + 1):
+            piece.append(cnt[p])
+            ids.append(p)
+    else:
+        for p in range(start, len(cnt)):
+            piece.append(cnt[p])
+            ids.append(p)
+        for p in range(0, end + 1):
+            piece.append(cnt[p])
+            ids.append(p)
+
+    return np.array(ids), np.array(piece)
+
+
+def get_union_points_loop(cnt_one, piece1, cnt_two, piece2):
+    union_points = []
+    for p1 in piece1:
+        for p2 in piece2:
+            if dist(cnt_one[p1][0], cnt_two[p2][0]) < 25:
+                union_points.append((p1, p2))
+
+    return union_points
+
+
+def penumbra_pair(radius, gap=4, seed=0):
+    # два соседних пятна с изрезанной границей, контур без аппроксимации
+    rng = np.random.default_rng(seed)
+    size = 4 * radius + gap + 40
+    cnts = []
+    for cx in (radius + 20, 3 * radius + gap + 20):
+        angles = np.linspace(0, 2 * np.pi, 720, endpoint=False)
+        r = radius * (1 + 0.02 * np.sin(7 * angles + rng.uniform(0, np.pi)))
+        poly = np.c_[cx + r * np.cos(angles), size / 2 + r * np.sin(angles)].astype(np.int32)
+        img = np.zeros((size, size), np.uint8)
+        cv2.fillPoly(img, [poly], 255)
+        cnt, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        cnts.append(max(cnt, key=len))
+
+    return cnts
+
+
+def best_of(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t)
+
+    return min(times), result
+
+
+if __name__ == "__main__":
+    for radius in (50, 100, 200):
+        cnt_one, cnt_two = penumbra_pair(radius)
+        # полный обход контура с переходом через нулевую точку
+        start, end = len(cnt_one) // 2, len(cnt_one) // 2 - 1
+
+        t_loop, (ids_loop, _) = best_of(lambda: get_cnt_piece_loop(cnt_one, start, end))
+        t_vec, (ids_vec, _) = best_of(lambda: get_cnt_piece(cnt_one, start, end, 'cw'))
+        assert np.array_equal(ids_loop, ids_vec)
+        print('get_cnt_piece    r=%3d  %6d pts   loop %8.2f ms  numpy %6.3f ms  x%.0f'
+              % (radius, len(ids_vec), t_loop * 1e3, t_vec * 1e3, t_loop / t_vec))
+
+        piece1 = np.arange(len(cnt_one))
+        piece2 = np.arange(len(cnt_two))[::-1]
+
+        t_loop, up_loop = best_of(lambda: get_union_points_loop(cnt_one, piece1, cnt_two, piece2), repeat=1)
+        t_vec, up_vec = best_of(lambda: get_union_points(cnt_one, piece1, cnt_two, piece2))
+        assert np.array_equal(np.array(up_loop).reshape(-1, 2), up_vec)
+        print('get_union_points r=%3d  %6d pairs loop %8.2f ms  numpy %6.3f ms  x%.0f'
+              % (radius, len(up_vec), t_loop * 1e3, t_vec * 1e3, t_loop / t_vec))
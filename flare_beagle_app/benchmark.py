@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import cv2
+import numpy as np
+from astropy.io import fits
+from image_processing import (Preprocessor, accum, detect_flare, get_close_spots, get_sunspot, hmi_calс,
+                              merge_close, preprocessing)
+from sunspot_table import SunspotTable
+from union_find import UnionFind
+from window_detector import WindowDetector
+
+
+# Набор замеров для горячих мест обработки на синтетических кадрах: диск с
+# потемнением к краю, яркие пятна (группами, чтобы было что склеивать),
+# нарастающая вспышка, заголовки с r_sun/crpix/WCS как у AIA lev1 и HMI.
+# Всё детерминировано сидами и не требует сети; результаты пишутся в JSON
+# и сравниваются с сохранённой базой.
+
+T0 = datetime(2013, 9, 29, 22, 0, 0)
+CADENCE = timedelta(seconds=12)
+
+
+def spot_layout(size, spots, seed=0):
+    # центры и размеры пятен одинаковы для всех кадров серии
+    rng = np.random.default_rng(1000 + seed)
+    r_sun = 0.39 * size
+    layout = []
+    for _ in range(spots):
+        a = rng.uniform(0, 2 * np.pi)
+        d = rng.uniform(0, 0.75) * r_sun
+        x, y = size / 2 + d * np.cos(a), size / 2 + d * np.sin(a)
+        sigma = rng.uniform(6, 14) * size / 1024
+        # группа из двух-трёх близких ядер
+        for _ in range(rng.integers(2, 4)):
+            layout.append((x + rng.normal(0, 2.5 * sigma), y + rng.normal(0, 2.5 * sigma), sigma,
+                           rng.choice((-1., 1.))))
+
+    return layout
+
+
+def gaussian(img, x, y, sigma, amplitude):
+    # добавление гауссианы только в её окрестности 4 sigma
+    h, w = img.shape
+    r = int(4 * sigma) + 1
+    x0, x1 = max(int(x) - r, 0), min(int(x) + r + 1, w)
+    y0, y1 = max(int(y) - r, 0), min(int(y) + r + 1, h)
+    if x0 >= x1 or y0 >= y1:
+        return
+    yy, xx = np.ogrid[y0:y1, x0:x1]
+    img[y0:y1, x0:x1] += amplitude * np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / (2 * sigma ** 2))
+
+
+def synthetic_frame(size=4096, spots=20, t=T0, flare=None, kind='aia', seed=0):
+    # flare - (x, y, sigma, amplitude); kind - 'aia' (171) или 'hmi' (магнитограмма)
+    rng = np.random.default_rng(seed)
+    r_sun = 0.39 * size
+    cx, cy = size / 2 - 0.5 + rng.uniform(-1, 1, 2)
+    yy, xx = np.ogrid[:size, :size]
+    rr2 = ((xx - cx) ** 2 + (yy - cy) ** 2).astype(np.float32) / np.float32(r_sun ** 2)
+
+    if kind == 'aia':
+        mu = np.sqrt(np.clip(1 - rr2, 0, 1))
+        img = np.where(rr2 <= 1, 1000 * (1 - 0.6 * (1 - mu)), 5).astype(np.float32)
+        for x, y, sigma, _ in spot_layout(size, spots):
+            gaussian(img, x, y, sigma, 3000)
+        if flare is not None:
+            gaussian(img, *flare)
+        img += rng.normal(0, 20, img.shape).astype(np.float32)
+    else:
+        img = np.zeros((size, size), np.float32)
+        for x, y, sigma, sign in spot_layout(size, spots):
+            gaussian(img, x, y, sigma, 1500 * sign)
+        img += rng.normal(0, 10, img.shape).astype(np.float32)
+        img[rr2 > 1] = 0
+
+    cdelt = (0.6 if kind == 'aia' else 0.504) * 4096 / size
+    header = fits.Header()
+    header['ctype1'], header['ctype2'] = 'HPLN-TAN', 'HPLT-TAN'
+    header['cunit1'], header['cunit2'] = 'arcsec', 'arcsec'
+    header['crpix1'], header['crpix2'] = cx + 1, cy + 1
+    header['crval1'], header['crval2'] = 0., 0.
+    header['cdelt1'], header['cdelt2'] = cdelt, cdelt
+    header['crota2'] = 0.
+    header['r_sun'] = r_sun
+    header['rsun_obs'] = r_sun * cdelt
+    header['dsun_obs'] = 1.496e11
+    header['date-obs'] = t.isoformat()
+    if kind == 'aia':
+        header['t_obs'] = t.strftime('%Y-%m-%dT%H:%M:%S.00Z')
+        header['wavelnth'] = 171
+        header['exptime'] = 2.
+    else:
+        header['t_obs'] = t.strftime('%Y.%m.%d_%H:%M:%S_TAI')
+    header['quality'] = 0
+
+    return img, header
+
+
+def write_frame(path, img, header):
+    # как и файлы lev1 из JSOC - сжатый (RICE) HDU после пустого первичного
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(img, header)]).writeto(path, overwrite=True)
+    return path
+
+
+def flare_at(i, frames, size, spots):
+    # вспышка у первого пятна, нарастает со второй половины серии
+    if i < frames // 2:
+        return None
+    x, y, sigma, _ = spot_layout(size, spots)[0]
+    grow = (i - frames // 2 + 1) / (frames - frames // 2)
+    return x + 3 * sigma, y, sigma * (1 + 2 * grow), 8000 * grow
+
+
+def make_series(directory, frames=4, size=4096, spots=20):
+    files = []
+    for i in range(frames):
+        t = T0 + i * CADENCE
+        img, header = synthetic_frame(size, spots, t, flare_at(i, frames, size, spots), seed=i)
+        files.append(write_frame(os.path.join(directory, 'aia.lev1_euv_12s.%s.171.image_lev1.fits'
+                                              % t.strftime('%Y-%m-%dT%H%M%SZ')), img, header))
+
+    img, header = synthetic_frame(size, spots, T0, kind='hmi', seed=frames)
+    hmi = write_frame(os.path.join(directory, 'hmi.m_45s.%s.magnetogram.fits' % T0.strftime('%Y%m%d_%H%M%S')),
+                      img, header)
+
+    return files, hmi
+
+
+# ---- замеры ----
+
+def best_of(func, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def peak_memory(func):
+    # пик выделений через tracemalloc (numpy отчитывается, буферы OpenCV - нет)
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def sunspots_of(thresh, min_area):
+    cnts, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return {i: get_sunspot(cnt) for i, cnt in enumerate(c for c in cnts if cv2.contourArea(c) >= min_area)}
+
+
+def flare_contour(files):
+    with fits.open(files[-2]) as one, fits.open(files[-1]) as two:
+        _, diff = detect_flare(one, two)
+    cnts, _ = cv2.findContours(diff, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    return max(cnts, key=cv2.contourArea)
+
+
+def stages(files, hmi, size):
+    # стадия: (функция, число кадров за вызов)
+    aia = [fits.open(path) for path in files]
+    for f in aia:
+        f[1].data
+    hmi = fits.open(hmi)
+    img_hmi = hmi[1].data
+
+    thresh = preprocessing(aia[0])
+    min_area = max(500 * (size / 4096) ** 2, 20)
+    sunspots = sunspots_of(thresh, min_area)
+    cnts, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    close_spots = get_close_spots(sunspots)
+    cnt = flare_contour(files)
+
+    disk = Preprocessor(threshold_mode='disk')
+    data, header = aia[0][1].data, aia[0][1].header
+    legacy = Preprocessor()
+
+    # скользящий фон: замер шага в установившемся окне
+    window = WindowDetector(thresh.shape, window=10)
+    for _ in range(10):
+        window.update(thresh)
+
+    def run_merge_close():
+        merge_close(dict(sunspots), close_spots, thresh.copy(), UnionFind(len(sunspots)))
+
+    funcs = {'preprocessing': (lambda: preprocessing(aia[0]), 1),
+             'detect_flare': (lambda: detect_flare(aia[-2], aia[-1]), 2),
+             # пороги по всему кадру и по гистограмме диска
+             'threshold_legacy': (lambda: legacy.process(data, header), 1),
+             'threshold_disk': (lambda: disk.process(data, header), 1),
+             'get_close_spots': (lambda: get_close_spots(sunspots), 1),
+             # пятна из контуров и близкие пары через SunspotTable
+             'sunspot_table': (lambda: SunspotTable.from_contours(cnts, min_area).close_spots(), 1),
+             'merge_close': (run_merge_close, 1),
+             'window_detect': (lambda: window.update(thresh), 1),
+             'accum': (lambda: accum(files, [sunspots[0]['center'] if sunspots else (0, 0)]), len(files)),
+             'hmi_calс': (lambda: hmi_calс(img_hmi, cnt, aia[-1][1].header, hmi[1].header), 1)}
+    info = {'sunspots': len(sunspots), 'close_pairs': len(close_spots), 'flare_points': len(cnt)}
+
+    return funcs, info, aia + [hmi]
+
+
+def run(sizes, spot_counts, frames=4, repeat=3, only=None, memory=True):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for spots in spot_counts:
+                files, hmi = make_series(directory, frames, size, spots)
+                funcs, info, opened = stages(files, hmi, size)
+                for stage, (func, n) in funcs.items():
+                    if only and stage not in only:
+                        continue
+                    func()
+                    seconds = best_of(func, repeat)
+                    results.append(dict(info, stage=stage, size=size, spots=spots, seconds=seconds,
+                                        frames_per_s=n / seconds,
+                                        peak_bytes=peak_memory(func) if memory else None,
+                                        max_rss=max_rss()))
+                    print('%-16s size=%5d spots=%3d %9.2f ms %8.2f frames/s %9s MB'
+                          % (stage, size, spots, seconds * 1e3, n / seconds,
+                             '%.1f' % (results[-1]['peak_bytes'] / 2 ** 20) if memory else '-'))
+                for f in opened:
+                    f.close()
+
+    return {'meta': {'date': datetime.utcnow().isoformat(),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'opencv': cv2.__version__,
+                     'machine': platform.machine(),
+                     'cpus': os.cpu_count(),
+                     'frames': frames,
+                     'repeat': repeat},
+            'results': results}
+
+
+def pad_frame(data, header, pad):
+    # тот же кадр с полосой неба шириной pad по краям
+    header = header.copy()
+    header['crpix1'] += pad
+    header['crpix2'] += pad
+    return np.pad(data, pad), header
+
+
+def baseline_preprocessing(data, header):
+    # preprocessing() в исходном виде, до Preprocessor и режимов порога:
+    # эталон, с которым побитово сверяется режим по умолчанию
+    norm_img = np.uint8(cv2.normalize(data, None, 0, 255, cv2.NORM_MINMAX))
+    r_sun = header['r_sun'] - 50
+    crpix = (header['crpix1'], header['crpix2'])
+
+    h, w = norm_img.shape
+    y, x = np.ogrid[:h, :w]
+    mask = np.sqrt((x - crpix[0]) ** 2 + (y - crpix[1]) ** 2) <= r_sun
+    masked_img = norm_img.copy()
+    masked_img[~mask] = 0
+
+    blur = cv2.GaussianBlur(masked_img, (5, 5), 0)
+    threshold = np.mean(blur) + 3 * np.std(blur)
+
+    return cv2.threshold(blur, threshold, 255, cv2.THRESH_BINARY)[1]
+
+
+def threshold_modes(sizes, spots, frames=4):
+    # проверка режимов порога на синтетических кадрах, без неба и с полосой
+    # неба по краям. Возвращает список (size, spots, файл, что не так):
+    #   legacy   - режим по умолчанию (Preprocessor и preprocessing())
+    #              побитово совпадает с исходным preprocessing();
+    #   disk     - preprocessing(f, 'disk') совпадает с Preprocessor;
+    #   mean+3σ  - порог disk равен mean + 3 * std по пикселям диска;
+    #   off-disk - маска disk не выходит за маску диска;
+    #   sky      - добавленное небо не меняет маску disk
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            for n in spots:
+                files, _ = make_series(directory, frames, size, n)
+                for path in files:
+                    legacy, disk = Preprocessor(), Preprocessor(threshold_mode='disk')
+                    with fits.open(path) as f:
+                        data, header = f[1].data, f[1].header
+                        baseline = baseline_preprocessing(data, header)
+                        thresh_legacy = legacy.process(data, header)
+                        thresh_disk = disk.process(data, header)
+                        checks = {'legacy': (np.array_equal(thresh_legacy, baseline)
+                                             and np.array_equal(preprocessing(f), baseline)),
+                                  'disk': np.array_equal(thresh_disk, preprocessing(f, 'disk'))}
+
+                        blur, mask = disk._buffers['blur'].copy(), disk._buffers['mask'].copy()
+                        inside = blur[mask]
+                        direct = np.mean(inside) + 3 * np.std(inside)
+                        checks['mean+3σ'] = abs(disk.last_threshold - direct) < 1e-6
+                        checks['off-disk'] = not thresh_disk[~mask].any()
+
+                        t_legacy = best_of(lambda: legacy.threshold(blur), 3)
+                        t_disk = best_of(lambda: disk.disk_threshold(blur, mask), 3)
+                        thresholds = legacy.last_threshold, disk.last_threshold
+
+                        pad = size // 4
+                        padded, padded_header = pad_frame(data, header, pad)
+                        legacy.process(padded, padded_header)
+                        thresh_padded = disk.process(padded, padded_header)
+                        checks['off-disk'] &= not thresh_padded[~disk._buffers['mask']].any()
+                        checks['sky'] = np.array_equal(thresh_padded[pad:-pad, pad:-pad], thresh_disk)
+
+                    failed = [name for name, ok in checks.items() if not ok]
+                    print('size=%5d spots=%3d  legacy %7.3f -> %7.3f with sky %6.2f ms  '
+                          'disk %7.3f -> %7.3f with sky %6.2f ms  pixels %d/%d%s'
+                          % (size, n, thresholds[0], legacy.last_threshold, t_legacy * 1e3,
+                             thresholds[1], disk.last_threshold, t_disk * 1e3,
+                             np.count_nonzero(thresh_legacy), np.count_nonzero(thresh_disk),
+                             '  FAILED: ' + ', '.join(failed) if failed else ''))
+                    failures.extend((size, n, os.path.basename(path), name) for name in failed)
+
+    return failures
+
+
+def compare(current, baseline, tolerance=0.2):
+    # замедление больше чем на tolerance относительно базы - регрессия
+    base = {(r['stage'], r['size'], r['spots']): r for r in baseline['results']}
+    regressions = []
+    for r in current['results']:
+        b = base.get((r['stage'], r['size'], r['spots']))
+        if b is None:
+            continue
+        ratio = r['seconds'] / b['seconds']
+        mark = ''
+        if ratio > 1 + tolerance:
+            mark = '  REGRESSION'
+            regressions.append((r['stage'], r['size'], r['spots'], ratio))
+        print('%-16s size=%5d spots=%3d  x%.2f%s' % (r['stage'], r['size'], r['spots'], ratio, mark))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='synthetic FITS benchmark of the image-processing stages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096])
+    parser.add_argument('--spots', type=int, nargs='+', default=[10, 40])
+    parser.add_argument('--frames', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--stages', nargs='+', help='run only these stages')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with a saved JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--threshold-modes', action='store_true',
+                        help='check the legacy and disk threshold modes and exit (1 on failure)')
+    args = parser.parse_args()
+
+    if args.threshold_modes:
+        sys.exit(1 if threshold_modes(args.sizes, args.spots, args.frames) else 0)
+
+    current = run(args.sizes, args.spots, args.frames, args.repeat, args.stages, not args.no_memory)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(current, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,141 @@
+import glob
+import os
+import re
+from datetime import datetime
+from astropy.time import Time
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from fits_io import read_header
+
+
+# ключи заголовка, которые дублируются в каталоге
+HEADER_KEYS = ('exptime', 'quality', 'r_sun', 'crpix1', 'crpix2', 'cdelt1', 'cdelt2', 'crota2')
+
+
+def parse_t_obs(value):
+    # AIA: 2013-09-29T22:00:01.34Z, HMI: 2013.09.29_22:00:45_TAI; результат
+    # в UTC: время HMI идёт по TAI, впереди UTC на число високосных секунд
+    # (35 с в 2013), и без перевода кадры разных приборов не сопоставить
+    tai = value.endswith('_TAI')
+    value = value.replace('_TAI', '').replace('_UTC', '').rstrip('Z')
+    if '_' in value:
+        date, time = value.split('_')
+        value = date.replace('.', '-') + 'T' + time
+
+    t_obs = datetime.fromisoformat(value)
+    if tai:
+        t_obs = Time(t_obs, scale='tai').utc.to_datetime()
+    return t_obs
+
+
+def series_name(path):
+    # aia.lev1_euv_12s.2013-09-29T220001Z.171.image_lev1.fits -> aia.lev1_euv_12s
+    return '.'.join(os.path.basename(path).split('.')[:2]).lower()
+
+
+class FitsCatalog:
+    # Каталог скачанных FITS-файлов: серия, длина волны, время наблюдения,
+    # путь, размер и основные ключи заголовка. Данные файлов не читаются.
+
+    def __init__(self, collection=None):
+        if collection is None:
+            from database import storeDB
+            collection = storeDB.fits_catalog
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index('path', unique=True)
+        self.collection.create_index([('series', ASCENDING), ('wave', ASCENDING), ('t_obs', ASCENDING)])
+        self.collection.create_index([('wave', ASCENDING), ('t_obs', ASCENDING)])
+
+    def record(self, path):
+        path = os.path.abspath(path)
+        header = read_header(path)
+        stat = os.stat(path)
+
+        record = {'path': path,
+                  'series': series_name(path),
+                  'wave': int(header.get('wavelnth', 0)),
+                  't_obs': parse_t_obs(header['t_obs']),
+                  'size': stat.st_size,
+                  'mtime': stat.st_mtime}
+        for key in HEADER_KEYS:
+            if key in header:
+                record[key] = header[key]
+
+        return record
+
+    def add(self, path):
+        record = self.record(path)
+        self.collection.update_one({'path': record['path']}, {'$set': record}, upsert=True)
+        return record
+
+    def add_many(self, paths):
+        ops = [UpdateOne({'path': r['path']}, {'$set': r}, upsert=True)
+               for r in map(self.record, paths)]
+        if ops:
+            self.collection.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    def scan(self, directory, pattern='*.fits'):
+        # добавляет только новые и изменившиеся файлы
+        directory = os.path.abspath(directory)
+        # с разделителем на конце: иначе downloads/aia захватит и downloads/aia_old
+        prefix = os.path.join(directory, '')
+        known = {r['path']: (r['size'], r['mtime'])
+                 for r in self.collection.find({'path': {'$regex': '^' + re.escape(prefix)}},
+                                               {'_id': 0, 'path': 1, 'size': 1, 'mtime': 1})}
+        changed = []
+        for path in glob.glob(os.path.join(directory, pattern)):
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime):
+                changed.append(path)
+
+        return self.add_many(changed)
+
+    def remove_missing(self):
+        missing = [r['path'] for r in self.collection.find({}, {'_id': 0, 'path': 1})
+                   if not os.path.exists(r['path'])]
+        if missing:
+            self.collection.delete_many({'path': {'$in': missing}})
+        return len(missing)
+
+    def _query(self, wave, series=None):
+        query = {'wave': wave}
+        if series is not None:
+            query['series'] = series
+        return query
+
+    def frames(self, wave, date_start=None, date_end=None, series=None):
+        # None вместо границы - интервал с этой стороны не ограничен
+        query = self._query(wave, series)
+        if date_start is not None:
+            query.setdefault('t_obs', {})['$gte'] = date_start
+        if date_end is not None:
+            query.setdefault('t_obs', {})['$lte'] = date_end
+        return list(self.collection.find(query, {'_id': 0}).sort('t_obs', ASCENDING))
+
+    def paths(self, wave, date_start=None, date_end=None, series=None):
+        return [r['path'] for r in self.frames(wave, date_start, date_end, series)]
+
+    def nearest(self, date, wave, series=None):
+        query = self._query(wave, series)
+        before = self.collection.find_one(dict(query, t_obs={'$lte': date}), {'_id': 0},
+                                          sort=[('t_obs', DESCENDING)])
+        after = self.collection.find_one(dict(query, t_obs={'$gte': date}), {'_id': 0},
+                                         sort=[('t_obs', ASCENDING)])
+        if before is None or after is None:
+            return before or after
+
+        return before if date - before['t_obs'] <= after['t_obs'] - date else after
+
+
+_catalog = None
+
+
+def get_catalog():
+    # общий каталог процесса: в него пишет загрузчик, из него берут кадры
+    # планировщик и детекторы
+    global _catalog
+    if _catalog is None:
+        _catalog = FitsCatalog()
+    return _catalog
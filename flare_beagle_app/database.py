@@ -1,9 +1,19 @@
-from pymongo import MongoClient
-
-client = MongoClient()
-
-storeDB = client.storeDB
-flare_beagleDB = client.flare_beagleDB
-
-if __name__ == "__main__":
+from datetime import datetime
+from pymongo import MongoClient
+
+client = MongoClient()
+
+storeDB = client.storeDB
+flare_beagleDB = client.flare_beagleDB
+
+
+def bump_version(db=None, name='flares'):
+    # версия коллекции для веб-части: по ней строятся ETag и ключи кэша
+    db = db if db is not None else flare_beagleDB
+    db.meta.update_one({'_id': name},
+                       {'$inc': {'version': 1}, '$set': {'updated': datetime.utcnow()}},
+                       upsert=True)
+
+
+if __name__ == "__main__":
     pass
\ No newline at end of file
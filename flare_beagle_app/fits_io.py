@@ -0,0 +1,87 @@
+from contextlib import contextmanager
+from astropy.io import fits
+import numpy as np
+import metrics
+
+
+@contextmanager
+def open_fits(path, hdu=1):
+    # memmap + ленивая загрузка HDU: данные читаются только при обращении,
+    # файл закрывается при выходе из блока
+    f = fits.open(path, memmap=True, lazy_load_hdus=True)
+    try:
+        f[hdu].verify("silentfix")
+        yield f
+    finally:
+        f.close()
+
+
+def read_header(path, hdu=1):
+    with open_fits(path, hdu) as f:
+        return f[hdu].header.copy()
+
+
+def _slices(roi, step):
+    if roi is None:
+        return slice(None, None, step), slice(None, None, step)
+
+    x0, y0, x1, y1 = roi
+    return slice(y0, y1, step), slice(x0, x1, step)
+
+
+def _detach(data):
+    # после закрытия файла массив не должен ссылаться на mmap,
+    # а cv2 работает только с нативным порядком байт
+    if isinstance(data, np.memmap) or data.dtype.byteorder not in '=|':
+        return np.array(data, dtype=data.dtype.newbyteorder('='), order='C')
+
+    return np.ascontiguousarray(data)
+
+
+def crop_header(header, roi=None, step=1):
+    # пересчёт опорного пикселя, радиуса и масштаба под вырезанную
+    # и/или прореженную область
+    header = header.copy()
+    x0, y0 = (0, 0) if roi is None else roi[:2]
+
+    header['crpix1'] = (header['crpix1'] - 1 - x0) / step + 1
+    header['crpix2'] = (header['crpix2'] - 1 - y0) / step + 1
+
+    if step != 1:
+        if 'r_sun' in header:
+            header['r_sun'] = header['r_sun'] / step
+        for key in ('cdelt1', 'cdelt2', 'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2'):
+            if key in header:
+                header[key] = header[key] * step
+
+    return header
+
+
+def read_data(path, hdu=1, roi=None, step=1):
+    # roi = (x0, y0, x1, y1) в пикселях полного кадра, step - прореживание
+    with open_fits(path, hdu) as f:
+        if roi is None and step == 1:
+            return _detach(f[hdu].data)
+
+        return _detach(f[hdu].section[_slices(roi, step)])
+
+
+@metrics.timed('fits_load')
+def read_frame(path, hdu=1, roi=None, step=1):
+    with open_fits(path, hdu) as f:
+        header = f[hdu].header
+        if roi is None and step == 1:
+            data = _detach(f[hdu].data)
+        else:
+            data = _detach(f[hdu].section[_slices(roi, step)])
+            header = crop_header(header, roi, step)
+
+        metrics.inc('bytes_read_total', data.nbytes)
+        return header.copy(), data
+
+
+def iter_frames(paths, hdu=1, roi=None, step=1):
+    # в каждый момент открыт только один файл
+    for path in paths:
+        header, data = read_frame(path, hdu, roi, step)
+        yield path, header, data
@@ -1,64 +1,251 @@
-from dotenv import load_dotenv
-from datetime import datetime, timedelta
-import drms
-import os
-
-load_dotenv()
-
-def aia_download_one(date, wave, out_dir):
-
-    date = str(date).replace(' ', '_')
-
-    qstr = '%s[%s][%d]{%s}' % ('aia.lev1_euv_12s', date, wave, 'image')
-
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
-    c = drms.Client()
-    r = c.export(qstr, method='url', protocol='fits', email=os.environ['JSOC_EXPORT_EMAIL'])
-    r.download(out_dir)
-
-    fmt = '%Y-%m-%dT%H%M%SZ'
-    filename = r.data['filename'][0]
-    real_date = datetime.strptime(filename.split('.')[2], fmt)
-
-    return filename, real_date
-
-
-def aia_download_series(date_start, date_end, wave, out_dir):
-    date_start = str(date_start).replace(' ', '_')
-    date_end = str(date_end).replace(' ', '_')
-
-    qstr = '%s[%s_UTC-%s_UTC][%d]{%s}' % ('aia.lev1_euv_12s', date_start, date_end, wave, 'image')
-
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
-    c = drms.Client()
-    r = c.export(qstr, method='url', protocol='fits', email=os.environ['JSOC_EXPORT_EMAIL'])
-    r.download(out_dir)
-
-
-def download_hmi_mag_45s(date_start, date_end, out_dir):
-    date_start = str(date_start).replace(' ', '_')
-    date_end = str(date_end).replace(' ', '_')
-
-    qstr = '%s[%s_UTC-%s_UTC]' % ('hmi.M_45s', date_start, date_end)
-
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
-    c = drms.Client()
-    r = c.export(qstr, method='url', protocol='fits', email=os.environ['JSOC_EXPORT_EMAIL'])
-    r.download(out_dir)
-
-
-if __name__ == "__main__":
-    # my_date_start = datetime.datetime(2019, 7, 18, 4, 30, 30, 5)
-    # my_date_end = datetime.datetime(2019, 7, 18, 4, 31, 30, 5)
-    my_date_start = datetime(2013, 9, 29, 21, 15, 00, 00)
-    my_date_end = datetime(2013, 9, 30, 8, 00, 30, 00)
-
-    # aia_download_series(my_date_start, my_date_end, 171, 'downloads/full_flare_12s')
-    # download_hmi_mag_45s(my_date_start, my_date_end, 'downloads/hmi')
-    download_aia_3m(my_date_start, 304, 'downloads/ris3')
+from dotenv import load_dotenv
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import logging
+import threading
+import shutil
+import time
+import drms
+import os
+import metrics
+from catalog import get_catalog
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+FITS_BLOCK = 2880
+
+
+def is_valid_fits(path):
+    # файл скачан целиком: FITS состоит из блоков по 2880 байт
+    # и начинается с ключевого слова SIMPLE
+    if not os.path.isfile(path):
+        return False
+
+    size = os.path.getsize(path)
+    if size == 0 or size % FITS_BLOCK:
+        return False
+
+    with open(path, 'rb') as f:
+        return f.read(6) == b'SIMPLE'
+
+
+def time_chunks(date_start, date_end, chunk):
+    while True:
+        end = min(date_start + chunk, date_end)
+        yield date_start, end
+        if end >= date_end:
+            break
+        date_start = end
+
+
+def content_size(headers, offset=0):
+    # полный размер файла: из Content-Range (206, 416) или
+    # Content-Length (200); None, если сервер его не сообщил
+    if headers is None:
+        return None
+    content_range = headers.get('Content-Range')
+    if content_range:
+        total = content_range.rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    length = headers.get('Content-Length')
+    return offset + int(length) if length and length.isdigit() else None
+
+
+def jsoc_date(date):
+    return str(date).replace(' ', '_')
+
+
+class JsocDownloader:
+    # Один drms-клиент на все запросы, длинные интервалы режутся на куски,
+    # файлы качаются параллельно ограниченным пулом. Уже скачанные и
+    # проверенные файлы пропускаются, недокачанные (.part) докачиваются
+    # через Range. client и opener можно подменить (например, фейковым
+    # клиентом и локальным сервером). Если передан catalog (FitsCatalog),
+    # каждый готовый файл заносится в него.
+
+    def __init__(self, client=None, email=None, workers=4, chunk=timedelta(hours=1),
+                 retries=3, timeout=60, progress=None, opener=urlopen, catalog=None):
+        self.client = client if client is not None else drms.Client()
+        self.email = email
+        self.workers = workers
+        self.chunk = chunk
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.opener = opener
+        self.catalog = catalog
+
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.failed = []
+        self._lock = threading.Lock()
+
+    def export(self, qstr):
+        email = self.email or os.environ['JSOC_EXPORT_EMAIL']
+        r = self.client.export(qstr, method='url', protocol='fits', email=email)
+        r.wait()
+        return r
+
+    def _fetch(self, url, path):
+        # готовность файла проверяется по размеру, который сообщил сервер:
+        # обрыв на границе блока FITS даёт файл, похожий на целый
+        part = path + '.part'
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            resp = self.opener(Request(url, headers=headers), timeout=self.timeout)
+        except HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # Range за концом файла: .part уже докачан целиком
+            # (прошлый запуск не успел его переименовать) или испорчен
+            if content_size(e.headers) == offset:
+                os.replace(part, path)
+                return
+            os.remove(part)
+            return self._fetch(url, path)
+
+        with resp:
+            # сервер мог проигнорировать Range - тогда пишем файл заново
+            resumed = offset > 0 and getattr(resp, 'status', 200) == 206
+            size = content_size(resp.headers, offset if resumed else 0)
+            with open(part, 'ab' if resumed else 'wb') as f:
+                shutil.copyfileobj(resp, f, 1 << 20)
+
+        got = os.path.getsize(part)
+        if size is not None and got != size:
+            # недокачанный .part докачается следующей попыткой
+            if got > size:
+                os.remove(part)
+            raise IOError('incomplete download (%d of %d bytes): %s' % (got, size, url))
+        os.replace(part, path)
+
+    @metrics.timed('download')
+    def download_file(self, url, path):
+        skipped = is_valid_fits(path)
+        error = None
+        if not skipped:
+            for attempt in range(self.retries):
+                try:
+                    self._fetch(url, path)
+                    error = None
+                    break
+                except OSError as e:
+                    error = e
+                    if attempt + 1 < self.retries:
+                        time.sleep(2 ** attempt)
+
+        if error is None and not skipped:
+            metrics.inc('frames_total', stage='download')
+            metrics.inc('bytes_downloaded_total', os.path.getsize(path))
+
+        if error is None and self.catalog is not None:
+            # ошибка каталога (нечитаемый заголовок, Mongo) не должна
+            # останавливать остальные загрузки
+            try:
+                self.catalog.add(path)
+            except Exception as e:
+                log.exception('cannot add %s to the catalog', path)
+                error = e
+
+        with self._lock:
+            self.done += 1
+            if skipped:
+                self.skipped += 1
+            if error is not None:
+                self.failed.append((url, path, error))
+            if self.progress is not None:
+                self.progress(self.done, self.total, path)
+
+        if error is not None:
+            return None
+        return path
+
+    def download_request(self, r, out_dir, seen=None):
+        # seen - имена файлов, уже взятых в загрузку (общее для кусков одной
+        # серии): интервалы JSOC включают оба конца, и запись на границе
+        # соседних кусков приходит в обоих
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        urls = [(filename, url) for filename, url in zip(r.urls['filename'], r.urls['url'])
+                if seen is None or filename not in seen]
+        if seen is not None:
+            seen.update(filename for filename, _ in urls)
+        with self._lock:
+            self.total += len(urls)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(self.download_file, url, os.path.join(out_dir, filename))
+                       for filename, url in urls]
+            paths = [f.result() for f in futures]
+
+        return [p for p in paths if p is not None]
+
+    def download_series(self, query, date_start, date_end, out_dir):
+        # query - шаблон запроса с местами под начало и конец интервала
+        paths = []
+        seen = set()
+        for start, end in time_chunks(date_start, date_end, self.chunk):
+            r = self.export(query % (jsoc_date(start), jsoc_date(end)))
+            paths.extend(self.download_request(r, out_dir, seen))
+
+        return paths
+
+    def aia_series(self, date_start, date_end, wave, out_dir):
+        query = '%s[%%s_UTC-%%s_UTC][%d]{%s}' % ('aia.lev1_euv_12s', wave, 'image')
+        return self.download_series(query, date_start, date_end, out_dir)
+
+    def hmi_mag_45s(self, date_start, date_end, out_dir):
+        query = '%s[%%s_UTC-%%s_UTC]' % 'hmi.M_45s'
+        return self.download_series(query, date_start, date_end, out_dir)
+
+    def aia_one(self, date, wave, out_dir):
+        qstr = '%s[%s][%d]{%s}' % ('aia.lev1_euv_12s', jsoc_date(date), wave, 'image')
+        r = self.export(qstr)
+        self.download_request(r, out_dir)
+
+        fmt = '%Y-%m-%dT%H%M%SZ'
+        filename = r.urls['filename'][0]
+        real_date = datetime.strptime(filename.split('.')[2], fmt)
+
+        return filename, real_date
+
+
+_downloader = None
+
+
+def get_downloader():
+    global _downloader
+    if _downloader is None:
+        _downloader = JsocDownloader(catalog=get_catalog())
+    return _downloader
+
+
+def aia_download_one(date, wave, out_dir):
+    return get_downloader().aia_one(date, wave, out_dir)
+
+
+def aia_download_series(date_start, date_end, wave, out_dir):
+    return get_downloader().aia_series(date_start, date_end, wave, out_dir)
+
+
+def download_hmi_mag_45s(date_start, date_end, out_dir):
+    return get_downloader().hmi_mag_45s(date_start, date_end, out_dir)
+
+
+if __name__ == "__main__":
+    # my_date_start = datetime.datetime(2019, 7, 18, 4, 30, 30, 5)
+    # my_date_end = datetime.datetime(2019, 7, 18, 4, 31, 30, 5)
+    my_date_start = datetime(2013, 9, 29, 21, 15, 00, 00)
+    my_date_end = datetime(2013, 9, 30, 8, 00, 30, 00)
+
+    # aia_download_series(my_date_start, my_date_end, 171, 'downloads/full_flare_12s')
+    # download_hmi_mag_45s(my_date_start, my_date_end, 'downloads/hmi')
+    download_aia_3m(my_date_start, 304, 'downloads/ris3')
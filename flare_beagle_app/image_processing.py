@@ -1,360 +1,713 @@
-import math
-from astropy.io import fits
-import matplotlib.pyplot as plt
-import glob
-import cv2
-import numpy as np
-from scipy import interpolate
-from astropy.wcs import WCS
-
-
-def dist(p1, p2):
-    return ((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2) ** 0.5
-
-
-def create_circular_mask(shape, center, radius):
-    h, w = shape
-    y, x = np.ogrid[:h, :w]
-    circular_mask = np.sqrt((x - center[0])**2 + (y-center[1])**2) <= radius
-
-    return circular_mask
-
-
-def preprocessing(fits_file):
-    norm_img = np.uint8(cv2.normalize(fits_file[1].data, None, 0, 255, cv2.NORM_MINMAX))
-
-    # radius of the Sun’s image in pixels
-    r_sun = fits_file[1].header['r_sun'] - 50
-
-    # location of disk center in x and y directions on image
-    crpix = (fits_file[1].header['crpix1'], fits_file[1].header['crpix2'])
-
-    mask = create_circular_mask(norm_img.shape, crpix, r_sun)
-    masked_img = norm_img.copy()
-    masked_img[~mask] = 0
-
-    blur = cv2.GaussianBlur(masked_img, (5, 5), 0)
-
-    # three sigma rule
-    threshold = np.mean(blur) + 3 * np.std(blur)
-
-    thresh = cv2.threshold(blur, threshold, 255, cv2.THRESH_BINARY)[1]
-
-    return thresh
-
-
-def get_sunspot(cnt):
-
-    m = cv2.moments(cnt)
-    cx = int(m["m10"] / m["m00"])
-    cy = int(m["m01"] / m["m00"])
-
-    sunspot = {'center': (cx, cy), 'cnt': cnt}
-    return sunspot
-
-
-def coord_system_rotate(cnt, angle):
-    c, s = math.cos(angle), math.sin(angle)
-
-    # v = np.array((c, s, -s, c))
-    v = np.array((c, -s, s, c))
-    v = v.reshape((2, 2))
-
-    new_cnt = cnt.copy()
-    new_cnt = np.dot(new_cnt, v)
-
-    return new_cnt.astype('int32')
-
-
-def get_close_spots(sunspots):
-    close_spots = {}
-
-    for i in range(len(sunspots) - 1):
-        for j in range(i + 1, len(sunspots)):
-            center_1 = sunspots[i]['center']
-            center_2 = sunspots[j]['center']
-
-            if dist(center_1, center_2) < 500:#1500
-                if center_1[0] < center_2[0]:
-                    s1 = i
-                    s2 = j
-                elif center_1[0] > center_2[0]:
-                    s1 = j
-                    s2 = i
-                elif center_1[0] == center_2[0]:
-                    if center_1[1] < center_2[1]:
-                        s1 = i
-                        s2 = j
-                    else:
-                        s1 = j
-                        s2 = i
-
-                a = math.atan2(sunspots[s2]['center'][1] - sunspots[s1]['center'][1],
-                               sunspots[s2]['center'][0] - sunspots[s1]['center'][0])
-                cnt_1 = sunspots[s1]['cnt']
-                cnt_2 = sunspots[s2]['cnt']
-
-                new_cntL = coord_system_rotate(cnt_1, a)
-                new_cntR = coord_system_rotate(cnt_2, a)
-
-                rightmost_l = new_cntL[new_cntL[:, :, 0].argmax()][0]
-                leftmost_r = new_cntR[new_cntR[:, :, 0].argmin()][0]
-
-                dist_x = leftmost_r[0] - rightmost_l[0]
-
-                if abs(dist_x) < 15: #150
-                    topmost_l = new_cntL[:, :, 1].argmax()
-                    bottommost_l = new_cntL[:, :, 1].argmin()
-
-                    topmost_r = new_cntR[:, :, 1].argmax()
-                    bottommost_r = new_cntR[:, :, 1].argmin()
-
-                    close_spots[(s1, s2)] = [topmost_l, bottommost_l, topmost_r, bottommost_r]
-
-    return close_spots
-
-def get_actual_id(id, sunspots_history):
-    while id != sunspots_history[id]:
-        id = sunspots_history[id]
-
-    return id
-
-def get_neighbors(cnt, point_id, direction, num):
-    if direction == 'ccw':
-        if point_id - num > 0:
-            return cnt[point_id:point_id - num:-3]
-        else:
-            return np.concatenate((cnt[point_id:0:-3], cnt[0:point_id-num]))
-
-    elif direction == 'cw':
-        if (point_id + num) > len(cnt):
-            return(np.concatenate((cnt[point_id:len(cnt):3], cnt[:len(cnt)-num:3])))
-        else:
-            return(cnt[point_id:point_id+num:3])
-
-
-def get_cnt_piece(cnt, start, end, direction):
-    piece = []
-    ids = []
-    if direction == 'cw':
-        if (start - end) < 0:
-            for p in range(start, 0, -1):
-                piece.append(cnt[p])
-                ids.append(p)
-            for p in range(0, end + 1):
-                piece.append(cnt[p])
-                ids.append(p)
-        else:
-            for p in range(start, len(cnt)):
-                piece.append(cnt[p])
-                ids.append(p)
-            for p in range(0, end+1):
-                piece.append(cnt[p])
-                ids.append(p)
-
-
-    return np.array(ids), np.array(piece)
-
-
-def spline(line, s):
-    x_points = []
-    y_points = []
-
-    for x in line[:, :, 0]:
-        x_points.append(*x)
-
-    for y in line[:, :, 1]:
-        y_points.append(*y)
-    x = np.array(x_points)
-    y = np.array(y_points)
-
-    dist = np.sqrt((x[:-1] - x[1:]) ** 2 + (y[:-1] - y[1:]) ** 2)
-    dist_along = np.concatenate(([0], dist.cumsum()))
-
-    spline, u = interpolate.splprep([x, y], u=dist_along, s=0)
-    d = np.arange(u[s-1], u[s+1], 0.1)
-    # d = np.arange(u[s], u[s+2], 0.1)
-    interp_x, interp_y = interpolate.splev(d, spline)
-
-    interp_x = np.rint(interp_x)
-    interp_y = np.rint(interp_y)
-
-    return np.array(interp_x), np.array(interp_y)
-
-
-def merge_close(sunspots, close_spots, img, sunspots_history):
-    new_cnts = []
-    img_points = img.copy()
-    for cs in close_spots:
-        actual_id = [get_actual_id(sunspots_history[cs[0]], sunspots_history),
-                     get_actual_id(sunspots_history[cs[1]], sunspots_history)]
-
-        spot_one = sunspots[actual_id[0]]
-        spot_two = sunspots[actual_id[1]]
-
-        topmost_l = close_spots[cs][0]
-        bottommost_l = close_spots[cs][1]
-
-        topmost_r = close_spots[cs][2]
-        bottommost_r = close_spots[cs][3]
-
-        piece1 = get_cnt_piece(spot_one['cnt'], topmost_l, bottommost_l, 'cw')[0]
-        piece2 = get_cnt_piece(spot_two['cnt'], bottommost_r, topmost_r, 'cw')[0]
-        piece2 = piece2[::-1]
-
-        union_points = []
-
-        for p1 in piece1:
-            for p2 in piece2:
-                d = dist(spot_one['cnt'][p1][0], spot_two['cnt'][p2][0])
-                if d < 25: #100
-                    union_points.append((p1, p2))
-
-        if len(union_points) > 2:
-
-            # Индексы точек объединения
-            up1 = union_points[0]
-            up2 = union_points[-1]
-
-            # Получение точек для построения сплайна
-            # -------------------------------------------------------------------------------------
-
-            line_one_1 = get_neighbors(spot_one['cnt'], up1[0], 'ccw', 15)[::-1]
-            line_one_2 = get_neighbors(spot_two['cnt'], up1[1], 'cw', 15)
-            line_two_1 = get_neighbors(spot_one['cnt'], up2[0], 'cw', 15)[::-1]
-            line_two_2 = get_neighbors(spot_two['cnt'], up2[1], 'ccw', 15)
-
-            line_one = np.concatenate((line_one_1, line_one_2))
-            line_two = np.concatenate((line_two_1, line_two_2))
-
-
-            for l in line_two:
-                cv2.circle(img_points, (l[0][0], l[0][1]), 1, (150, 150, 150), 2)
-            for l in line_one:
-                cv2.circle(img_points, (l[0][0], l[0][1]), 1, (150, 150, 150), 2)
-            # Сплайн
-            if len(line_one) > 3:
-                xnew, ynew = spline(line_one, len(line_one_1))
-                l = np.unique(np.array(np.c_[xnew, ynew]), axis=0)
-                for i in l:
-                    img[int(i[1]), int(i[0])] = 255
-                    pass
-
-            if len(line_two) > 3:
-                xnew, ynew = spline(line_two, len(line_two_1))
-                l = np.unique(np.array(np.c_[xnew, ynew]), axis=0)
-                for i in l:
-                    img[int(i[1]), int(i[0])] = 255
-                    pass
-
-            # -------------------------------------------------------------------------------------
-
-            # Изменение контура
-            cnt_part_1 = get_cnt_piece(spot_one['cnt'], up2[0], up1[0], 'cw')[1]
-            cnt_part_2 = get_cnt_piece(spot_two['cnt'], up1[1], up2[1], 'cw')[1]
-            # print(spot_one['cnt'][up1[0]], spot_two['cnt'][up1[1]], line_one[0], line_one[-1])
-            # print(np.where(spot_one['cnt'][-1] == line_one))
-            new_cnt = np.concatenate((cnt_part_1[1:-1], line_one, cnt_part_2[1:-1], line_two))
-
-            # print(cnt_part_1[-1], line_one[0])
-            # new_cnt = get_cnt_piece(spot_one['cnt'], up2[0], up1[0], 'cw')[1]
-            # new_cnt = np.concatenate((new_cnt, get_cnt_piece(spot_two['cnt'], up1[1], up2[1], 'cw')[1]))
-
-            # cv2.drawContours(img, [new_cnt], -1, (255, 255, 255), -1)
-            # cv2.drawContours(img, [new_cnt], -1, (255, 255, 255), 1)
-
-            new_cnts.append(new_cnt)
-            sunspots_history[actual_id[0]] = sunspots_history[actual_id[1]] = len(sunspots)
-            sunspots_history = np.append(sunspots_history, len(sunspots_history))
-
-            sunspots[len(sunspots_history)-1] = get_sunspot(new_cnt)
-
-    return img, img_points
-
-
-import sunpy.visualization.colormaps as cm
-sdoaia171 = plt.get_cmap('sdoaia171')
-
-
-def detect_flare(fits_img_one, fits_img_two):
-    spots = []
-    # смотрим разницу между обработанными изображениями
-    diff = cv2.absdiff(preprocessing(fits_img_two), preprocessing(fits_img_one))
-
-    # морфологические операции, чтобы убрать лишний мусор
-    diff = cv2.morphologyEx(diff, cv2.MORPH_OPEN, np.ones((3, 3)), iterations=2)
-    diff = cv2.morphologyEx(diff, cv2.MORPH_CLOSE, np.ones((3, 3)), iterations=1)
-
-    # поиск контуров с большой площадью
-    cnts, _ = cv2.findContours(diff.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cnts = [cnt for cnt in cnts if cv2.contourArea(cnt) >= 500]
-
-    # если обнаружили что-то большое
-    if len(cnts) > 0:
-        x = y = []
-        for cnt in cnts:
-            m = cv2.moments(cnt)
-            cx = int(m["m10"] / m["m00"])
-            cy = int(m["m01"] / m["m00"])
-            x.append(cx)
-            y.append(cy)
-        spots.append((int(np.mean(x)), int(np.mean(y))))
-    diff.fill(0)
-    cv2.drawContours(diff, cnts, -1, (255, 255, 255), -1)
-    return spots, diff
-
-
-def accum(files, spots):
-    # al = cv2.bitwise_or(al, diff)
-    # print(np.var(img_next)) -- иногда приходит мусор, его можно почистить вот так
-    sum_contour = np.zeros((4096, 4096), dtype='uint8')
-    print("---", len(files))
-    for i in range(0, len(files)):
-        f = fits.open(files[i])
-        f.verify("silentfix")
-
-        image_prep = preprocessing(f)
-        thresh = cv2.morphologyEx(image_prep, cv2.MORPH_CLOSE,
-                                   cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)), iterations=1)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN,
-                                   cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)), iterations=1)
-
-        cnts, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        # cnts = [cnt for cnt in cnts if cv2.contourArea(cnt) > 150]
-
-        # thresh.fill(0)
-        # cv2.drawContours(thresh, cnts, -1, (255, 255, 255), -1)
-
-        sunspots = {}
-        sum_contour = cv2.bitwise_or(thresh, sum_contour)
-        for i, cnt in enumerate(cnts):
-            s = get_sunspot(cnt)
-            # print(dist(s['center'], spots[0]) )
-            if dist(s['center'], spots[0]) < 500:
-                pass
-                # sunspots.append(s)
-                # cv2.drawContours(sum_contour, [cnt], -1, (255, 255, 255), -1)
-    return sum_contour
-
-def hmi_calс(img_hmi, cnt, header_aia, header_hmi):
-    aia_wcs = WCS(header_aia)
-    hmi_wcs = WCS(header_hmi)
-
-
-    # a = np.zeros_like((4096, 4096), dtype='uint8')
-    a = np.zeros_like(img_hmi)
-    for i, p in enumerate(cnt):
-        aia_pix2world = aia_wcs.wcs_pix2world(((p[0][0], p[0][1]),), 1)
-        new_pix = hmi_wcs.wcs_world2pix(aia_pix2world, 0)
-
-        cv2.circle(img_hmi, (int(new_pix[0][0]), int(new_pix[0][1])), 1, (3000, 3000, 3000), 20)
-        # cnt[i] = np.rint(new_pix)
-
-    return img_hmi
-
-
-if __name__ == "__main__":
-    # files_12s = glob.glob("downloads/2013_12s/*.image_lev1.fits")
-    # files_12s = glob.glob("downloads/full_flare_12s/*.image_lev1.fits")
-    # files_5m = glob.glob("downloads/2013_5m/*.image_lev1.fits")
-    # files_hmi = glob.glob("downloads/hmi/*.magnetogram.fits")
\ No newline at end of file
+import math
+from datetime import datetime
+import re
+from functools import lru_cache
+from astropy.io import fits
+import matplotlib.pyplot as plt
+import glob
+import cv2
+import numpy as np
+from scipy import interpolate
+from scipy.spatial import cKDTree
+from astropy.wcs import WCS
+from fits_io import iter_frames
+from catalog import get_catalog
+from union_find import UnionFind
+from accumulator import ContourAccumulator
+import metrics
+
+
+def dist(p1, p2):
+    return ((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2) ** 0.5
+
+
+def create_circular_mask(shape, center, radius):
+    h, w = shape
+    y, x = np.ogrid[:h, :w]
+    circular_mask = np.sqrt((x - center[0])**2 + (y-center[1])**2) <= radius
+
+    return circular_mask
+
+
+# режимы порога: по всему кадру (как было) или только по диску
+THRESHOLD_MODES = ('legacy', 'disk')
+BLUR_MODES = ('gaussian', 'median')
+
+
+def hist_threshold(hist):
+    # mean + 3 * std по гистограмме значений uint8 (256 бинов)
+    hist = np.asarray(hist, dtype=np.float64).ravel()
+    n = hist.sum()
+    if n == 0:
+        return 255.
+    levels = np.arange(len(hist))
+    mean = np.dot(hist, levels) / n
+    std = np.sqrt(np.dot(hist, (levels - mean) ** 2) / n)
+
+    return mean + 3 * std
+
+
+def preprocessing(fits_file, threshold_mode='legacy'):
+    if threshold_mode not in THRESHOLD_MODES:
+        raise ValueError('unknown threshold mode: %s' % threshold_mode)
+    norm_img = np.uint8(cv2.normalize(fits_file[1].data, None, 0, 255, cv2.NORM_MINMAX))
+
+    # radius of the Sun’s image in pixels
+    r_sun = fits_file[1].header['r_sun'] - 50
+
+    # location of disk center in x and y directions on image
+    crpix = (fits_file[1].header['crpix1'], fits_file[1].header['crpix2'])
+
+    mask = create_circular_mask(norm_img.shape, crpix, r_sun)
+    masked_img = norm_img.copy()
+    masked_img[~mask] = 0
+
+    blur = cv2.GaussianBlur(masked_img, (5, 5), 0)
+
+    # three sigma rule
+    if threshold_mode == 'disk':
+        threshold = hist_threshold(cv2.calcHist([blur], [0], mask.view(np.uint8), [256], [0, 256]))
+    else:
+        threshold = np.mean(blur) + 3 * np.std(blur)
+
+    thresh = cv2.threshold(blur, threshold, 255, cv2.THRESH_BINARY)[1]
+
+    return thresh
+
+
+class Preprocessor:
+    # То же, что preprocessing(), но без выделения памяти на каждый кадр:
+    # рабочие буферы переиспользуются, маска диска кэшируется по
+    # (shape, crpix, r_sun). При mask_tol=0 результат побитово совпадает
+    # с preprocessing(); ненулевой допуск позволяет не пересчитывать маску
+    # при дрожании центра/радиуса на доли пикселя.
+    # threshold_mode: 'legacy' - порог по всему кадру, как в preprocessing();
+    # 'disk' - по гистограмме пикселей внутри маски диска, за один проход и
+    # без зависимости от того, сколько неба попало в кадр.
+    # blur ('gaussian' или 'median') с ядром blur_ksize и close_kernel
+    # (замыкание маски после порога) - для вариантов вроде spots_merge.py.
+
+    def __init__(self, r_sun_offset=50, mask_tol=0.0, block_rows=256, threshold_mode='legacy',
+                 blur='gaussian', blur_ksize=5, close_kernel=None):
+        if threshold_mode not in THRESHOLD_MODES:
+            raise ValueError('unknown threshold mode: %s' % threshold_mode)
+        if blur not in BLUR_MODES:
+            raise ValueError('unknown blur: %s' % blur)
+        self.r_sun_offset = r_sun_offset
+        self.threshold_mode = threshold_mode
+        self.blur = blur
+        self.blur_ksize = blur_ksize
+        self.close_kernel = close_kernel
+        self.mask_tol = mask_tol
+        self.block_rows = block_rows
+        self._mask_key = None
+        self._buffers = {}
+        self.last_threshold = None
+
+    def _buffer(self, name, shape, dtype):
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buf
+        return buf
+
+    def _mask_cached(self, shape, crpix, r_sun):
+        if self._mask_key is None:
+            return False
+        cached_shape, cached_crpix, cached_r_sun = self._mask_key
+        return (cached_shape == shape
+                and abs(cached_crpix[0] - crpix[0]) <= self.mask_tol
+                and abs(cached_crpix[1] - crpix[1]) <= self.mask_tol
+                and abs(cached_r_sun - r_sun) <= self.mask_tol)
+
+    def disk_mask(self, shape, crpix, r_sun):
+        if self._mask_cached(shape, crpix, r_sun):
+            return self._buffers['mask']
+
+        # та же арифметика, что в create_circular_mask, но по блокам строк,
+        # чтобы не создавать float-сетку размером с кадр
+        h, w = shape
+        mask = self._buffer('mask', shape, np.bool_)
+        rows = self._buffer('mask_rows', (min(self.block_rows, h), w), np.float64)
+        dx2 = (np.arange(w) - crpix[0]) ** 2
+        for y0 in range(0, h, self.block_rows):
+            y1 = min(y0 + self.block_rows, h)
+            block = rows[:y1 - y0]
+            np.add(dx2, (np.arange(y0, y1)[:, np.newaxis] - crpix[1]) ** 2, out=block)
+            np.sqrt(block, out=block)
+            np.less_equal(block, r_sun, out=mask[y0:y1])
+
+        self._mask_key = (shape, crpix, r_sun)
+        return mask
+
+    def threshold(self, blur):
+        # np.mean(blur) + 3 * np.std(blur) через заранее выделенный буфер
+        n = blur.size
+        mean = np.add.reduce(blur, axis=None, dtype=np.float64) / n
+        dev = self._buffer('dev', blur.shape, np.float64)
+        np.subtract(blur, mean, out=dev)
+        np.multiply(dev, dev, out=dev)
+        std = np.sqrt(np.add.reduce(dev, axis=None) / n)
+
+        return mean + 3 * std
+
+    def disk_threshold(self, blur, mask):
+        # тот же порог, но только по пикселям диска: гистограмма uint8 за один проход
+        return hist_threshold(cv2.calcHist([blur], [0], mask.view(np.uint8), [256], [0, 256]))
+
+    def normalize(self, data, norm_range=None):
+        norm = self._buffer('norm', data.shape, data.dtype.newbyteorder('='))
+        if norm_range is None:
+            cv2.normalize(data, norm, 0, 255, cv2.NORM_MINMAX)
+            return norm
+
+        # заданный диапазон (например, от всего кадра при обработке его части).
+        # data * scale + shift одним шагом с той же арифметикой и округлением,
+        # что у cv2.normalize: по отдельности умножение и сдвиг округлялись
+        # бы до целого типа каждый
+        lo, hi = norm_range
+        scale = 255. / (hi - lo) if hi > lo else 0.
+        cv2.addWeighted(data, scale, data, 0, -lo * scale, dst=norm)
+        np.clip(norm, 0, 255, out=norm)
+        return norm
+
+    @metrics.timed('preprocessing')
+    def process(self, data, header, out=None, norm_range=None, threshold=None):
+        # norm_range и threshold позволяют взять нормировку и порог снаружи,
+        # вместо того чтобы считать их по самому data
+        shape = data.shape
+
+        norm = self.normalize(data, norm_range)
+        img = self._buffer('img', shape, np.uint8)
+        np.copyto(img, norm, casting='unsafe')
+
+        # radius of the Sun’s image in pixels
+        r_sun = header['r_sun'] - self.r_sun_offset
+
+        # location of disk center in x and y directions on image
+        crpix = (header['crpix1'], header['crpix2'])
+
+        mask = self.disk_mask(shape, crpix, r_sun)
+        np.multiply(img, mask, out=img)
+
+        blur = self._buffer('blur', shape, np.uint8)
+        if self.blur == 'median':
+            cv2.medianBlur(img, self.blur_ksize, dst=blur)
+        else:
+            cv2.GaussianBlur(img, (self.blur_ksize, self.blur_ksize), 0, dst=blur)
+
+        # three sigma rule
+        if threshold is None:
+            if self.threshold_mode == 'disk':
+                threshold = self.disk_threshold(blur, mask)
+            else:
+                threshold = self.threshold(blur)
+        self.last_threshold = threshold
+
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        if self.close_kernel is None:
+            cv2.threshold(blur, threshold, 255, cv2.THRESH_BINARY, dst=out)
+        else:
+            thresh = self._buffer('thresh', shape, np.uint8)
+            cv2.threshold(blur, threshold, 255, cv2.THRESH_BINARY, dst=thresh)
+            cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, self.close_kernel, dst=out, iterations=1)
+
+        return out
+
+    def __call__(self, fits_file, out=None):
+        return self.process(fits_file[1].data, fits_file[1].header, out=out)
+
+
+def get_sunspot(cnt):
+
+    m = cv2.moments(cnt)
+    cx = int(m["m10"] / m["m00"])
+    cy = int(m["m01"] / m["m00"])
+
+    sunspot = {'center': (cx, cy), 'cnt': cnt}
+    return sunspot
+
+
+def coord_system_rotate(cnt, angle):
+    c, s = math.cos(angle), math.sin(angle)
+
+    # v = np.array((c, s, -s, c))
+    v = np.array((c, -s, s, c))
+    v = v.reshape((2, 2))
+
+    new_cnt = cnt.copy()
+    new_cnt = np.dot(new_cnt, v)
+
+    return new_cnt.astype('int32')
+
+
+def _segment_argext(values, starts, lengths, reduce):
+    # экстремум и индекс его первого вхождения внутри каждого сегмента
+    ext = reduce.reduceat(values, starts)
+    hits = np.where(values == np.repeat(ext, lengths), np.arange(len(values)), len(values))
+    return ext, np.minimum.reduceat(hits, starts) - starts
+
+
+def _gather_segments(points, offsets, lengths):
+    # склеивает контуры с заданными смещениями в один массив точек
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    idx = np.arange(lengths.sum()) - np.repeat(starts - offsets, lengths)
+    return points[idx], starts
+
+
+def _rotate_segments(points, offsets, lengths, angles):
+    # coord_system_rotate для каждого контура со своим углом. Поворот - тем
+    # же np.dot по каждому контуру: поэлементное x * c + y * s округляется
+    # иначе и на границе усечения до int32 меняет зазор на 1 пиксель
+    pts, starts = _gather_segments(points, offsets, lengths)
+    rotated = [coord_system_rotate(pts[start:start + n].reshape(-1, 1, 2), angle)
+               for start, n, angle in zip(starts.tolist(), lengths.tolist(), angles)]
+    rotated = np.concatenate(rotated).reshape(-1, 2)
+    return rotated[:, 0], rotated[:, 1], starts
+
+
+def close_spot_pairs(centers, points, offsets, lengths, max_dist=500, max_gap=15):
+    # centers (n, 2), points - все контуры одним массивом (N, 2),
+    # offsets/lengths - положение контура каждого пятна в points
+    close_spots = {}
+    if len(centers) < 2:
+        return close_spots
+
+    # радиус пятна - максимальное удаление точки контура от центра
+    d2 = ((points - np.repeat(centers, lengths, axis=0)) ** 2).sum(axis=1)
+    radius = np.sqrt(np.maximum.reduceat(d2, offsets))
+
+    # пара может пройти проверку по зазору, только если центры ближе суммы
+    # радиусов плюс допуск (+2 на округление координат до int)
+    reach = min(max_dist, 2 * radius.max() + max_gap + 2)
+    pairs = cKDTree(centers).query_pairs(reach, output_type='ndarray')
+    if len(pairs) == 0:
+        return close_spots
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    delta = centers[j] - centers[i]
+    d2 = (delta ** 2).sum(axis=1)
+    keep = (d2 < max_dist ** 2) & (np.sqrt(d2) < radius[i] + radius[j] + max_gap + 2)
+    i, j = i[keep], j[keep]
+    if len(i) == 0:
+        return close_spots
+
+    # левое пятно - с меньшим x (при равенстве - с меньшим y)
+    ci, cj = centers[i], centers[j]
+    left_first = (ci[:, 0] < cj[:, 0]) | ((ci[:, 0] == cj[:, 0]) & (ci[:, 1] < cj[:, 1]))
+    s1 = np.where(left_first, i, j)
+    s2 = np.where(left_first, j, i)
+
+    angles = [math.atan2(centers[b][1] - centers[a][1], centers[b][0] - centers[a][0])
+              for a, b in zip(s1.tolist(), s2.tolist())]
+
+    x_l, y_l, starts_l = _rotate_segments(points, offsets[s1], lengths[s1], angles)
+    x_r, y_r, starts_r = _rotate_segments(points, offsets[s2], lengths[s2], angles)
+
+    rightmost_l = np.maximum.reduceat(x_l, starts_l)
+    leftmost_r = np.minimum.reduceat(x_r, starts_r)
+
+    near = np.flatnonzero(np.abs(leftmost_r - rightmost_l) < max_gap)
+    if len(near) == 0:
+        return close_spots
+
+    lengths_l, lengths_r = lengths[s1[near]], lengths[s2[near]]
+    y_l, starts_l = _gather_segments(y_l, starts_l[near], lengths_l)
+    y_r, starts_r = _gather_segments(y_r, starts_r[near], lengths_r)
+
+    topmost_l = _segment_argext(y_l, starts_l, lengths_l, np.maximum)[1]
+    bottommost_l = _segment_argext(y_l, starts_l, lengths_l, np.minimum)[1]
+    topmost_r = _segment_argext(y_r, starts_r, lengths_r, np.maximum)[1]
+    bottommost_r = _segment_argext(y_r, starts_r, lengths_r, np.minimum)[1]
+
+    for k, n in enumerate(near.tolist()):
+        close_spots[(int(s1[n]), int(s2[n]))] = [int(topmost_l[k]), int(bottommost_l[k]),
+                                                 int(topmost_r[k]), int(bottommost_r[k])]
+
+    return close_spots
+
+
+@metrics.timed('get_close_spots')
+def get_close_spots(sunspots):
+    n = len(sunspots)
+    if n < 2:
+        return {}
+
+    cnts = [sunspots[i]['cnt'].reshape(-1, 2) for i in range(n)]
+    lengths = np.array([len(cnt) for cnt in cnts])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    centers = np.array([sunspots[i]['center'] for i in range(n)])
+
+    return close_spot_pairs(centers, np.concatenate(cnts), offsets, lengths)
+
+def get_actual_id(id, sunspots_history):
+    while id != sunspots_history[id]:
+        id = sunspots_history[id]
+
+    return id
+
+def get_neighbors(cnt, point_id, direction, num):
+    if direction == 'ccw':
+        if point_id - num > 0:
+            return cnt[point_id:point_id - num:-3]
+        else:
+            return np.concatenate((cnt[point_id:0:-3], cnt[0:point_id-num]))
+
+    elif direction == 'cw':
+        if (point_id + num) > len(cnt):
+            return(np.concatenate((cnt[point_id:len(cnt):3], cnt[:len(cnt)-num:3])))
+        else:
+            return(cnt[point_id:point_id+num:3])
+
+
+def get_cnt_piece(cnt, start, end, direction):
+    if direction != 'cw':
+        return np.array([]), np.array([])
+
+    if (start - end) < 0:
+        ids = np.concatenate((np.arange(start, 0, -1), np.arange(0, end + 1)))
+    else:
+        # от start до конца контура и дальше с начала до end включительно
+        ids = (start + np.arange(len(cnt) - start + end + 1)) % len(cnt)
+
+    return ids, cnt[ids]
+
+
+def get_union_points(cnt_one, ids_one, cnt_two, ids_two, max_dist=25, block=1 << 20):
+    # все пары (p1, p2) точек ближе max_dist в порядке вложенного цикла
+    # по ids_one и ids_two; расстояния считаются блоками строк
+    points_one = cnt_one[ids_one].reshape(-1, 2).astype(np.int64)
+    points_two = cnt_two[ids_two].reshape(-1, 2).astype(np.int64)
+
+    union_points = [np.empty((0, 2), dtype=np.int64)]
+    rows = max(1, block // max(len(points_two), 1))
+    for r0 in range(0, len(points_one), rows):
+        d2 = ((points_one[r0:r0 + rows, np.newaxis] - points_two[np.newaxis]) ** 2).sum(axis=2)
+        i, j = np.nonzero(d2 < max_dist ** 2)
+        union_points.append(np.column_stack((ids_one[r0 + i], ids_two[j])))
+
+    return np.concatenate(union_points)
+
+
+def spline(line, s):
+    x = line[:, 0, 0]
+    y = line[:, 0, 1]
+
+    dist = np.sqrt((x[:-1] - x[1:]) ** 2 + (y[:-1] - y[1:]) ** 2)
+    dist_along = np.concatenate(([0], dist.cumsum()))
+
+    spline, u = interpolate.splprep([x, y], u=dist_along, s=0)
+    d = np.arange(u[s-1], u[s+1], 0.1)
+    # d = np.arange(u[s], u[s+2], 0.1)
+    interp_x, interp_y = interpolate.splev(d, spline)
+
+    interp_x = np.rint(interp_x)
+    interp_y = np.rint(interp_y)
+
+    return np.array(interp_x), np.array(interp_y)
+
+
+def bridge_points(bridges):
+    # точки всех перемычек кадра одним массивом; bridges - список (line, s).
+    # splprep строится для каждой перемычки отдельно: у каждой своя
+    # параметризация u, а FITPACK подгоняет одну кривую за вызов
+    xs = [np.empty(0)]
+    ys = [np.empty(0)]
+    for line, s in bridges:
+        # s + 1 должен попасть в линию, а повторяющиеся соседние точки
+        # splprep не принимает - такие перемычки пропускаются
+        if not 0 < s < len(line) - 1:
+            continue
+        try:
+            x, y = spline(line, s)
+        except ValueError:
+            continue
+        xs.append(x)
+        ys.append(y)
+
+    return np.concatenate(xs).astype(np.intp), np.concatenate(ys).astype(np.intp)
+
+
+def draw_bridges(img, bridges):
+    # перемычки рисуются в img одной индексацией, точки за краем отбрасываются
+    x, y = bridge_points(bridges)
+    h, w = img.shape[:2]
+    inside = (x >= 0) & (x < w) & (y >= 0) & (y < h)
+    img[y[inside], x[inside]] = 255
+
+
+def merge_spot_pair(spot_one, spot_two, extremes, img, img_points=None, bridges=None):
+    # склейка двух близких пятен. Возвращает новый контур или None, если
+    # точек стыка слишком мало. Перемычки добавляются в bridges, если он
+    # передан (рисуются потом все сразу), иначе сразу рисуются в img
+    topmost_l, bottommost_l, topmost_r, bottommost_r = extremes
+
+    piece1 = get_cnt_piece(spot_one['cnt'], topmost_l, bottommost_l, 'cw')[0]
+    piece2 = get_cnt_piece(spot_two['cnt'], bottommost_r, topmost_r, 'cw')[0]
+    piece2 = piece2[::-1]
+
+    union_points = get_union_points(spot_one['cnt'], piece1, spot_two['cnt'], piece2)
+
+    if len(union_points) <= 2:
+        return None
+
+    # Индексы точек объединения
+    up1 = union_points[0]
+    up2 = union_points[-1]
+
+    # Получение точек для построения сплайна
+    # -------------------------------------------------------------------------------------
+
+    line_one_1 = get_neighbors(spot_one['cnt'], up1[0], 'ccw', 15)[::-1]
+    line_one_2 = get_neighbors(spot_two['cnt'], up1[1], 'cw', 15)
+    line_two_1 = get_neighbors(spot_one['cnt'], up2[0], 'cw', 15)[::-1]
+    line_two_2 = get_neighbors(spot_two['cnt'], up2[1], 'ccw', 15)
+
+    line_one = np.concatenate((line_one_1, line_one_2))
+    line_two = np.concatenate((line_two_1, line_two_2))
+
+    if img_points is not None:
+        for l in line_two:
+            cv2.circle(img_points, (l[0][0], l[0][1]), 1, (150, 150, 150), 2)
+        for l in line_one:
+            cv2.circle(img_points, (l[0][0], l[0][1]), 1, (150, 150, 150), 2)
+
+    # Сплайн
+    pair_bridges = []
+    if len(line_one) > 3:
+        pair_bridges.append((line_one, len(line_one_1)))
+    if len(line_two) > 3:
+        pair_bridges.append((line_two, len(line_two_1)))
+
+    if bridges is None:
+        draw_bridges(img, pair_bridges)
+    else:
+        bridges.extend(pair_bridges)
+
+    # -------------------------------------------------------------------------------------
+
+    # Изменение контура
+    cnt_part_1 = get_cnt_piece(spot_one['cnt'], up2[0], up1[0], 'cw')[1]
+    cnt_part_2 = get_cnt_piece(spot_two['cnt'], up1[1], up2[1], 'cw')[1]
+    # print(spot_one['cnt'][up1[0]], spot_two['cnt'][up1[1]], line_one[0], line_one[-1])
+    # print(np.where(spot_one['cnt'][-1] == line_one))
+    new_cnt = np.concatenate((cnt_part_1[1:-1], line_one, cnt_part_2[1:-1], line_two))
+
+    # print(cnt_part_1[-1], line_one[0])
+    # new_cnt = get_cnt_piece(spot_one['cnt'], up2[0], up1[0], 'cw')[1]
+    # new_cnt = np.concatenate((new_cnt, get_cnt_piece(spot_two['cnt'], up1[1], up2[1], 'cw')[1]))
+
+    # cv2.drawContours(img, [new_cnt], -1, (255, 255, 255), -1)
+    # cv2.drawContours(img, [new_cnt], -1, (255, 255, 255), 1)
+
+    return new_cnt
+
+
+def _merge_pass(sunspots, close_spots, img, graph, img_points=None):
+    # пятна, уже склеенные в этом проходе, пропускаются: индексы крайних
+    # точек в close_spots относятся к их старым контурам. Перемычки всех
+    # пар рисуются в конце прохода. Возвращает {корень: новый контур}
+    merged = {}
+    bridges = []
+    for cs in close_spots:
+        a, b = graph.find(cs[0]), graph.find(cs[1])
+        if a == b or a in merged or b in merged:
+            continue
+
+        new_cnt = merge_spot_pair(sunspots[a], sunspots[b], close_spots[cs], img, img_points, bridges)
+        if new_cnt is None:
+            continue
+
+        root = graph.union(a, b)
+        del sunspots[b if root == a else a]
+        sunspots[root] = get_sunspot(new_cnt)
+        merged[root] = new_cnt
+
+    draw_bridges(img, bridges)
+    return merged
+
+
+@metrics.timed('merge_close')
+def merge_close(sunspots, close_spots, img, graph):
+    # graph - UnionFind по ключам sunspots; склеенное пятно хранится
+    # под ключом корня множества
+    img_points = img.copy()
+    merged = _merge_pass(sunspots, close_spots, img, graph, img_points)
+
+    return img, img_points, merged
+
+
+def merge_sunspots(sunspots, img, max_passes=100):
+    # склеивает пятна проход за проходом, пока находятся близкие пары,
+    # так что цепочки из трёх и более пятен объединяются транзитивно.
+    # sunspots - словарь с ключами 0..n-1, как после get_sunspot()
+    graph = UnionFind(len(sunspots))
+    merged = dict(sunspots)
+
+    for _ in range(max_passes):
+        ids = sorted(merged)
+        close_spots = get_close_spots({i: merged[k] for i, k in enumerate(ids)})
+        close_spots = {(ids[i], ids[j]): v for (i, j), v in close_spots.items()}
+        if not _merge_pass(merged, close_spots, img, graph):
+            break
+
+    return merged, img
+
+
+import sunpy.visualization.colormaps as cm
+sdoaia171 = plt.get_cmap('sdoaia171')
+
+
+def flare_contours(thresh_one, thresh_two, min_area=500):
+    # смотрим разницу между обработанными изображениями
+    diff = cv2.absdiff(thresh_two, thresh_one)
+
+    # морфологические операции, чтобы убрать лишний мусор
+    diff = cv2.morphologyEx(diff, cv2.MORPH_OPEN, np.ones((3, 3)), iterations=2)
+    diff = cv2.morphologyEx(diff, cv2.MORPH_CLOSE, np.ones((3, 3)), iterations=1)
+
+    # поиск контуров с большой площадью
+    with metrics.stage('find_contours'):
+        cnts, _ = cv2.findContours(diff.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cnts = [cnt for cnt in cnts if cv2.contourArea(cnt) >= min_area]
+
+    return cnts, diff
+
+
+def flare_spots(cnts):
+    spots = []
+    # если обнаружили что-то большое
+    if len(cnts) > 0:
+        x = y = []
+        for cnt in cnts:
+            m = cv2.moments(cnt)
+            cx = int(m["m10"] / m["m00"])
+            cy = int(m["m01"] / m["m00"])
+            x.append(cx)
+            y.append(cy)
+        spots.append((int(np.mean(x)), int(np.mean(y))))
+    return spots
+
+
+def find_flare(thresh_one, thresh_two, min_area=500):
+    cnts, diff = flare_contours(thresh_one, thresh_two, min_area)
+    spots = flare_spots(cnts)
+
+    diff.fill(0)
+    cv2.drawContours(diff, cnts, -1, (255, 255, 255), -1)
+    return spots, diff
+
+
+def detect_flare(fits_img_one, fits_img_two):
+    return find_flare(preprocessing(fits_img_one), preprocessing(fits_img_two))
+
+
+def detect_flare_series(files, preprocessor=None):
+    # каждый кадр обрабатывается один раз: маска предыдущего кадра
+    # хранится до следующей пары, два буфера масок чередуются
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    prev_thresh = spare = None
+    for _, header, data in iter_frames(files):
+        thresh = preprocessor.process(data, header, out=spare)
+
+        if prev_thresh is not None:
+            yield find_flare(prev_thresh, thresh)
+        spare, prev_thresh = prev_thresh, thresh
+
+
+def smooth_thresh(image_prep):
+    thresh = cv2.morphologyEx(image_prep, cv2.MORPH_CLOSE,
+                              cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)), iterations=1)
+    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN,
+                              cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)), iterations=1)
+    return thresh
+
+
+def accum(files, spots, preprocessor=None):
+    # al = cv2.bitwise_or(al, diff)
+    # print(np.var(img_next)) -- иногда приходит мусор, его можно почистить вот так
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+
+    acc = None
+    image_prep = None
+    print("---", len(files))
+    for _, header, data in iter_frames(files):
+        if acc is None:
+            acc = ContourAccumulator(data.shape)
+        image_prep = preprocessor.process(data, header, out=image_prep)
+        thresh = smooth_thresh(image_prep)
+
+        cnts, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # cnts = [cnt for cnt in cnts if cv2.contourArea(cnt) > 150]
+
+        # thresh.fill(0)
+        # cv2.drawContours(thresh, cnts, -1, (255, 255, 255), -1)
+
+        sunspots = {}
+        acc.update(thresh)
+        for i, cnt in enumerate(cnts):
+            s = get_sunspot(cnt)
+            # print(dist(s['center'], spots[0]) )
+            if dist(s['center'], spots[0]) < 500:
+                pass
+                # sunspots.append(s)
+                # cv2.drawContours(sum_contour, [cnt], -1, (255, 255, 255), -1)
+    if acc is None:
+        return np.zeros((4096, 4096), dtype='uint8')
+    return acc.sum_contour
+
+# ключевые слова заголовка, от которых зависит WCS
+_WCS_KEY = re.compile(r'^(NAXIS\d*|WCSAXES|CRPIX\d|CRVAL\d|CDELT\d|CTYPE\d|CUNIT\d|CROTA\d|'
+                      r'PC\d_\d|CD\d_\d|PV\d_\d+|LONPOLE|LATPOLE|RADESYS|EQUINOX|DATE-OBS|MJD-OBS|'
+                      r'RSUN_REF|DSUN_OBS|[HC]GL[NT]_OBS|CRL[NT]_OBS)$')
+
+
+@lru_cache(maxsize=64)
+def _cached_wcs(signature):
+    return WCS(fits.Header(list(signature)))
+
+
+def header_wcs(header):
+    # WCS кэшируется по значениям WCS-ключей заголовка
+    return _cached_wcs(tuple((k, v) for k, v in header.items() if _WCS_KEY.match(k)))
+
+
+def reproject_contour(cnt, header_aia, header_hmi):
+    # все точки контура переводятся из пикселей AIA в пиксели HMI за один вызов
+    world = header_wcs(header_aia).wcs_pix2world(cnt.reshape(-1, 2), 1)
+    new_pix = header_wcs(header_hmi).wcs_world2pix(world, 0)
+
+    return new_pix.astype('int32').reshape(-1, 1, 2)
+
+
+def hmi_calс(img_hmi, cnt, header_aia, header_hmi, rasterize=True):
+    # контур вспышки на магнитограмме HMI; img_hmi не изменяется,
+    # при rasterize=True дополнительно возвращается маска области
+    new_cnt = reproject_contour(cnt, header_aia, header_hmi)
+
+    mask = None
+    if rasterize:
+        mask = np.zeros(img_hmi.shape[:2], dtype='uint8')
+        cv2.drawContours(mask, [new_cnt], -1, 255, -1)
+
+    return new_cnt, mask
+
+
+if __name__ == "__main__":
+    # files_12s = glob.glob("downloads/2013_12s/*.image_lev1.fits")
+    # files_12s = glob.glob("downloads/full_flare_12s/*.image_lev1.fits")
+    # files_5m = glob.glob("downloads/2013_5m/*.image_lev1.fits")
+    # files_hmi = glob.glob("downloads/hmi/*.magnetogram.fits")
+
+    catalog = get_catalog()
+    catalog.ensure_indexes()
+    catalog.scan("downloads/2013_12s")
+    files_12s = catalog.paths(171, datetime(2013, 9, 29, 21, 15), datetime(2013, 9, 30, 8, 0, 30))
+    for spots, diff in detect_flare_series(files_12s):
+        if spots:
+            print(spots)
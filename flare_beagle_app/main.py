@@ -1,53 +1,93 @@
-from datetime import datetime
-import time
-import os
-import random
-from datetime import datetime, timedelta
-from database import storeDB, flaresDB
-from my_scheduler import scheduler
-from get_jsoc_data import download_aia_3m, download_aia_12s,  download_hmi_mag_45s
-
-
-def get_aia_3m():
-    if storeDB.aia171_3m.count_documents({}) == 0:
-        # вот тут надо взять ту дату, которая вернулась рельная с запроса.
-        download_date = str(datetime(2013, 9, 29, 22, 0, 0, 1))
-        record = {'download_date' : download_date, 'date': datetime.utcnow()}
-        storeDB.aia171_3m.insert_one(record).inserted_id
-    else:
-        download_date = storeDB.aia171_3m.find_one(sort=[{'_id', -1}])['download_date']
-        download_date = str(datetime.strptime(download_date, '%Y-%m-%d %H:%M:%S.%f') + timedelta(minutes=5))
-        record = {'download_date': download_date, 'date': datetime.utcnow()}
-        storeDB.aia171_3m.insert_one(record).inserted_id
-
-    file_name = download_aia_3m(download_date, 171, 'downloads/test_aia3m')
-    #тут надо перезаписать дату
-    # db_schedule.aia171_3m.update_one({'download_date': download_date}, {'$set': {'downloaded': True},
-    #                                                                     {'file_name' : file_name}}, upsert=True)
-
-
-def event_detector():
-    if storeDB.aia171_3m.count_documents({}) >= 2:
-        pass
-
-def test():
-    print('i test task')
-    time.sleep(10)
-
-if __name__ == '__main__':
-    # max_instances - задание может исполняться в более чем одном экземпляре процесса (7)
-    # scheduler.add_job(get_aia_3m, 'interval', minutes=5, max_instances=5,  executor='default')
-    # scheduler.add_job(event_detector, 'interval', minutes=5, max_instances=5, executor='default')
-    test_job = scheduler.add_job(test, 'interval', seconds=3, max_instances=5, executor='default')
-    print(test_job)
-    scheduler.start()
-    test_job.remove()
-    try:
-        while True:
-            time.sleep(3)
-
-    except KeyboardInterrupt:
-        pass
-
-
-    scheduler.shutdown()
\ No newline at end of file
+from datetime import datetime
+import time
+import os
+import random
+from datetime import datetime, timedelta
+from my_scheduler import scheduler
+from catalog import get_catalog
+from get_jsoc_data import aia_download_one
+from pipeline import FramePipeline
+from repository import Repository
+import metrics
+
+
+OUT_DIR = 'downloads/test_aia3m'
+WAVE = 171
+SERIES = 'aia.lev1_euv_12s'
+
+repository = Repository()
+catalog = get_catalog()
+
+
+def get_aia_3m():
+    last = repository.last_frame(WAVE, SERIES)
+    if last is None:
+        download_date = datetime(2013, 9, 29, 22, 0, 0, 1)
+    else:
+        download_date = last['t_obs'] + timedelta(minutes=5)
+
+    file_name, real_date = aia_download_one(download_date, WAVE, OUT_DIR)
+    # кадр берётся из каталога (загрузчик заносит туда каждый готовый файл),
+    # t_obs - из заголовка, а не из имени файла
+    frame = catalog.nearest(real_date, WAVE, SERIES)
+    if frame is None or os.path.basename(frame['path']) != file_name:
+        # файл не скачался - запоминаем дату, чтобы следующий запуск пошёл дальше
+        repository.frame_state(os.path.abspath(os.path.join(OUT_DIR, file_name)), real_date, WAVE, SERIES,
+                               'failed')
+        return
+
+    repository.frame_state(frame['path'], frame['t_obs'], WAVE, SERIES, 'downloaded')
+
+    # при полной очереди задание ждёт здесь, следующие запуски пропускаются
+    pipeline.put(frame['path'])
+
+
+def on_result(result):
+    repository.frame_state(result['path_two'], result['t_obs'], WAVE, SERIES, 'detected')
+    if result['spots']:
+        repository.detection(result, WAVE)
+
+
+def on_failure(pair):
+    repository.frame_failed(pair[1])
+
+
+def report():
+    print(pipeline.stats())
+
+
+pipeline = FramePipeline(scheduler, maxsize=16, max_inflight=4, on_result=on_result, on_failure=on_failure)
+
+
+def test():
+    print('i test task')
+    time.sleep(10)
+
+if __name__ == '__main__':
+    repository.ensure_indexes()
+    catalog.ensure_indexes()
+    # файлы, скачанные до запуска
+    if os.path.isdir(OUT_DIR):
+        catalog.scan(OUT_DIR)
+    if metrics.ENABLED:
+        metrics.serve(int(os.environ.get('FLARE_BEAGLE_METRICS_PORT', 9108)))
+        if os.environ.get('FLARE_BEAGLE_METRICS_TEXTFILE'):
+            scheduler.add_job(metrics.registry.write_textfile, 'interval', seconds=15, executor='default',
+                              args=[os.environ['FLARE_BEAGLE_METRICS_TEXTFILE']])
+    # max_instances - задание может исполняться в более чем одном экземпляре процесса (7)
+    scheduler.add_job(get_aia_3m, 'interval', minutes=5, max_instances=1, executor='default')
+    scheduler.add_job(report, 'interval', minutes=1, executor='default')
+    scheduler.add_job(repository.flush, 'interval', seconds=5, executor='default')
+    scheduler.start()
+    pipeline.start()
+    try:
+        while True:
+            time.sleep(3)
+
+    except KeyboardInterrupt:
+        pass
+
+
+    pipeline.stop()
+    scheduler.shutdown()
+    repository.flush()
\ No newline at end of file
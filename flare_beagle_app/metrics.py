@@ -0,0 +1,235 @@
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Метрики конвейера в формате Prometheus: счётчики, значения (gauge) и
+# гистограммы длительности стадий. Включаются переменной окружения
+# FLARE_BEAGLE_METRICS=1 при запуске процесса; выключенные stage() и
+# timed() ничего не делают (timed возвращает исходную функцию).
+# FLARE_BEAGLE_PROFILE=<файл> - профиль cProfile одного кадра.
+
+ENABLED = os.environ.get('FLARE_BEAGLE_METRICS', '') not in ('', '0', 'false')
+PROFILE = os.environ.get('FLARE_BEAGLE_PROFILE')
+
+PREFIX = 'flare_beagle_'
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_noop = nullcontext()
+
+
+class Registry:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(self.buckets), 0., 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h[0][i] += 1
+                    break
+            h[1] += value
+            h[2] += 1
+
+    # ---- передача между процессами ----
+
+    def drain(self):
+        # накопленное с прошлого вызова - для пересылки из процесса пула
+        with self._lock:
+            data = {'counters': self.counters, 'histograms': self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return data
+
+    def merge(self, data):
+        with self._lock:
+            for key, value in data['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, total, count) in data['histograms'].items():
+                h = self.histograms.get(key)
+                if h is None:
+                    h = self.histograms[key] = [[0] * len(self.buckets), 0., 0]
+                h[0] = [a + b for a, b in zip(h[0], counts)]
+                h[1] += total
+                h[2] += count
+
+    # ---- вывод ----
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((k, (list(h[0]), h[1], h[2])) for k, h in self.histograms.items())
+
+        typed = set()
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                if name not in typed:
+                    typed.add(name)
+                    if name in self.help:
+                        lines.append('# HELP %s%s %s' % (PREFIX, name, self.help[name]))
+                    lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+                lines.append('%s%s%s %s' % (PREFIX, name, _labels(labels), _number(value)))
+
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append('# HELP %s%s %s' % (PREFIX, name, self.help[name]))
+                lines.append('# TYPE %s%s histogram' % (PREFIX, name))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s%s_bucket%s %d' % (PREFIX, name, _labels(labels + (('le', _number(bound)),)),
+                                                  cumulative))
+            lines.append('%s%s_bucket%s %d' % (PREFIX, name, _labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s%s_sum%s %s' % (PREFIX, name, _labels(labels), _number(total)))
+            lines.append('%s%s_count%s %d' % (PREFIX, name, _labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # для textfile-коллектора node_exporter: запись через временный файл
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+registry.help.update({
+    'stage_seconds': 'Duration of pipeline stages',
+    'frames_total': 'Frames processed by stage',
+    'bytes_read_total': 'Bytes of image data read from FITS files',
+    'bytes_downloaded_total': 'Bytes downloaded from JSOC',
+})
+
+
+@contextmanager
+def _stage(name):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe('stage_seconds', time.perf_counter() - t, stage=name)
+
+
+def stage(name):
+    # with stage('preprocessing'): ...
+    return _stage(name) if ENABLED else _noop
+
+
+def timed(name):
+    # декоратор: длительность каждого вызова попадает в stage_seconds{stage=name}
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inc(name, value=1, **labels):
+    if ENABLED:
+        registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if ENABLED:
+        registry.observe(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    if ENABLED:
+        registry.set(name, value, **labels)
+
+
+# ---- профилирование ----
+
+_profiled = False
+
+
+@contextmanager
+def profile_once(path=None):
+    # профиль только первого вызова в процессе; path по умолчанию - FLARE_BEAGLE_PROFILE
+    global _profiled
+    path = path or PROFILE
+    if path is None or _profiled:
+        yield
+        return
+
+    _profiled = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats('%s.%d' % (path, os.getpid()))
+
+
+# ---- выдача ----
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=9108, host=''):
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
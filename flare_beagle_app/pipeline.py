@@ -0,0 +1,371 @@
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import cv2
+import numpy as np
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED
+from batch import memmap_dir
+from catalog import get_catalog, parse_t_obs
+from fits_io import read_frame
+from image_processing import Preprocessor, find_flare
+import metrics
+
+
+# Конвейер "скачивание -> поиск вспышек": задания скачивания кладут готовые
+# кадры в ограниченную очередь (put блокируется, пока очередь полна),
+# диспетчер собирает из них пары соседних кадров и отправляет одноразовые
+# задания на executor='processpool'. Число заданий в работе ограничено,
+# упавшие пары возвращаются в очередь до max_retries раз.
+# Каждый кадр обрабатывается один раз: для него отправляется задание
+# preprocess_frame, которое кладёт маску в кэш масок (файлы в /dev/shm, если
+# там есть место), а задание пары уходит, только когда готовы маски обоих
+# её кадров, и лишь сравнивает их. Кадры по-прежнему обрабатываются
+# параллельно; маска удаляется, когда обе пары с этим кадром завершены.
+# С mask_cache=False каждое задание пары строит обе маски само.
+
+
+_preprocessor = None
+
+
+def _get_preprocessor():
+    global _preprocessor
+    if _preprocessor is None:
+        _preprocessor = Preprocessor()
+    return _preprocessor
+
+
+def _save_mask(path, thresh, t_obs):
+    # через временный файл: читающий процесс видит либо весь файл, либо ничего
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, thresh=thresh, t_obs=np.array(t_obs.isoformat()))
+    os.replace(tmp, path)
+
+
+def _load_mask(path):
+    try:
+        with np.load(path) as data:
+            return data['thresh'], datetime.fromisoformat(str(data['t_obs']))
+    except FileNotFoundError:
+        return None
+
+
+def _frame_mask(path, cache=None):
+    # маска из кэша; если её там нет (кэш выключен или файл пропал) - строится заново
+    if cache is not None:
+        cached = _load_mask(cache)
+        metrics.inc('mask_cache_total', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return cached
+
+    header, data = read_frame(path)
+    return _get_preprocessor().process(data, header), parse_t_obs(header['t_obs'])
+
+
+def preprocess_frame(path, cache):
+    # выполняется в процессе пула: маска кадра для заданий пар
+    with metrics.profile_once():
+        header, data = read_frame(path)
+        _save_mask(cache, _get_preprocessor().process(data, header), parse_t_obs(header['t_obs']))
+
+    return {'metrics': metrics.registry.drain() if metrics.ENABLED else None}
+
+
+def detect_pair(path_one, path_two, cache_one=None, cache_two=None):
+    # выполняется в процессе пула, поэтому функция модульного уровня;
+    # cache_one/cache_two - файлы масок кадров в кэше
+    with metrics.profile_once():
+        thresh_one, t_prev = _frame_mask(path_one, cache_one)
+        thresh_two, t_obs = _frame_mask(path_two, cache_two)
+        spots, diff = find_flare(thresh_one, thresh_two)
+
+    # маска разности в процесс планировщика не передаётся - только площадь;
+    # метрики процесса пула пересылаются вместе с результатом
+    return {'path_one': path_one,
+            'path_two': path_two,
+            't_prev': t_prev,
+            't_obs': t_obs,
+            'spots': spots,
+            'area': cv2.countNonZero(diff),
+            'metrics': metrics.registry.drain() if metrics.ENABLED else None}
+
+
+class FramePipeline:
+
+    # mask_cache=False - каждое задание пары строит обе маски само;
+    # frame_bytes - оценка размера маски для выбора каталога кэша
+
+    def __init__(self, scheduler, maxsize=16, max_inflight=4, max_retries=3,
+                 executor='processpool', on_result=None, on_failure=None,
+                 mask_cache=True, frame_bytes=4096 * 4096):
+        self.scheduler = scheduler
+        self.frames = queue.Queue(maxsize)
+        self.retries = deque()
+        self.max_retries = max_retries
+        self.executor = executor
+        self.on_result = on_result
+        self.on_failure = on_failure
+
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.inflight = {}
+        self.prev = None
+        self.ids = itertools.count()
+        self.seqs = itertools.count()
+
+        self.mask_cache = mask_cache
+        self.frame_bytes = frame_bytes
+        self.max_inflight = max_inflight
+        self.cache_dir = None
+        # кадры с маской в кэше по номеру: путь, состояние ('pending',
+        # 'ready', 'failed') и число ещё не завершённых пар с этим кадром;
+        # ready - пары, маски обоих кадров которых готовы
+        self.masks = {}
+        self.ready = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._dispatcher = None
+
+        self.done = 0
+        self.failed = 0
+        self.requeued = 0
+        self.last_latency = None
+        self.last_t_obs = None
+
+    # ---- производитель ----
+
+    def put(self, path, block=True, timeout=None):
+        # блокируется при полной очереди - так скачивание не убегает вперёд
+        self.frames.put((path, time.monotonic()), block, timeout)
+
+    def put_range(self, wave, date_start=None, date_end=None, series=None, catalog=None):
+        # дообработка архива: кадры интервала из каталога в порядке t_obs
+        paths = (catalog or get_catalog()).paths(wave, date_start, date_end, series)
+        for path in paths:
+            self.put(path)
+        return len(paths)
+
+    # ---- диспетчер ----
+
+    def collect(self):
+        # значения для /metrics обновляются в момент выдачи
+        stats = self.stats()
+        for key in ('depth', 'inflight', 'retries', 'queue_lag'):
+            metrics.set_gauge('pipeline_' + key, stats[key])
+        if stats['data_lag'] is not None:
+            metrics.set_gauge('pipeline_data_lag', stats['data_lag'])
+
+    def start(self):
+        if metrics.ENABLED:
+            metrics.registry.collectors.append(self.collect)
+        if self.mask_cache and self.cache_dir is None:
+            # готовые пары уходят раньше новых кадров, поэтому масок в кэше
+            # не больше, чем заданий в работе и в повторе, плюс пара
+            nbytes = (2 * self.max_inflight + 2) * self.frame_bytes
+            self.cache_dir = tempfile.mkdtemp(prefix='flare_beagle_masks_', dir=memmap_dir(nbytes))
+        self.scheduler.add_listener(self._on_event, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+        self._stop.clear()
+        self._dispatcher = threading.Thread(target=self._dispatch, name='frame-pipeline', daemon=True)
+        self._dispatcher.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._dispatcher is not None:
+            self._dispatcher.join(timeout)
+        self.scheduler.remove_listener(self._on_event)
+        if self.collect in metrics.registry.collectors:
+            metrics.registry.collectors.remove(self.collect)
+        if self.cache_dir is not None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            self.cache_dir = None
+            self.masks.clear()
+            self.ready.clear()
+
+    def _cache_path(self, seq):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, '%d.npz' % seq)
+
+    def _pair_item(self, prev, seq, path, enqueued):
+        return {'kind': 'pair', 'pair': (prev[0], path), 'seqs': (prev[1], seq),
+                'enqueued': enqueued, 'attempts': 0}
+
+    def _next_item(self):
+        # повторы, затем пары с готовыми масками, затем новые кадры
+        with self._lock:
+            if self.retries:
+                return self.retries.popleft()
+            if self.ready:
+                return self.ready.popleft()
+
+        try:
+            path, enqueued = self.frames.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+        self.frames.task_done()
+        seq = next(self.seqs)
+        prev, self.prev = self.prev, (path, seq)
+        if self.cache_dir is None:
+            if prev is None:
+                return None
+            return self._pair_item(prev, seq, path, enqueued)
+
+        with self._lock:
+            # у первого кадра (и первого после перезапуска) пара только одна - со следующим
+            self.masks[seq] = {'path': path, 'enqueued': enqueued, 'state': 'pending',
+                               'pairs': 2 if prev is not None and prev[1] in self.masks else 1}
+        return {'kind': 'frame', 'path': path, 'seq': seq, 'enqueued': enqueued, 'attempts': 0}
+
+    def _job(self, item):
+        if item['kind'] == 'frame':
+            return preprocess_frame, (item['path'], self._cache_path(item['seq']))
+        return detect_pair, item['pair'] + tuple(self._cache_path(seq) for seq in item['seqs'])
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            if not self.slots.acquire(timeout=0.5):
+                continue
+
+            item = self._next_item()
+            if item is None:
+                self.slots.release()
+                continue
+
+            func, args = self._job(item)
+            job_id = '%s-%d' % (func.__name__, next(self.ids))
+            with self._lock:
+                self.inflight[job_id] = item
+            try:
+                self.scheduler.add_job(func, args=args, id=job_id,
+                                       executor=self.executor, misfire_grace_time=None)
+            except Exception:
+                with self._lock:
+                    del self.inflight[job_id]
+                self._requeue(item)
+                self.slots.release()
+
+    def _requeue(self, item):
+        item['attempts'] += 1
+        with self._lock:
+            if item['attempts'] <= self.max_retries:
+                self.requeued += 1
+                self.retries.append(item)
+                return
+
+        if item['kind'] == 'frame':
+            self._frame_done(item['seq'], 'failed')
+        else:
+            self._pair_failed(item)
+
+    def _pair_failed(self, item):
+        with self._lock:
+            self.failed += 1
+        self._pair_done(item)
+        if self.on_failure is not None:
+            self.on_failure(item['pair'])
+
+    def _frame_done(self, seq, state):
+        # кадр обработан или окончательно упал: пары с ним, у которых
+        # второй кадр тоже завершён, уходят в работу или считаются упавшими
+        failed = []
+        with self._lock:
+            if seq not in self.masks:
+                return
+            self.masks[seq]['state'] = state
+            for one in (seq - 1, seq):
+                a, b = self.masks.get(one), self.masks.get(one + 1)
+                if a is None or b is None or 'pending' in (a['state'], b['state']):
+                    continue
+                item = self._pair_item((a['path'], one), one + 1, b['path'], b['enqueued'])
+                if a['state'] == b['state'] == 'ready':
+                    self.ready.append(item)
+                else:
+                    failed.append(item)
+
+        for item in failed:
+            self._pair_failed(item)
+
+    def _pair_done(self, item):
+        # маска больше не нужна, когда завершены обе пары с её кадром
+        if self.cache_dir is None:
+            return
+        stale = []
+        with self._lock:
+            for seq in item['seqs']:
+                mask = self.masks.get(seq)
+                if mask is None:
+                    continue
+                mask['pairs'] -= 1
+                if mask['pairs'] == 0:
+                    del self.masks[seq]
+                    stale.append(seq)
+
+        for seq in stale:
+            try:
+                os.remove(self._cache_path(seq))
+            except (OSError, TypeError):
+                pass
+
+    def _on_event(self, event):
+        with self._lock:
+            item = self.inflight.pop(event.job_id, None)
+        if item is None:
+            return
+
+        self.slots.release()
+        if event.exception is not None:
+            metrics.inc('pipeline_errors_total')
+            self._requeue(item)
+            return
+
+        if event.retval['metrics'] is not None:
+            metrics.registry.merge(event.retval['metrics'])
+        if item['kind'] == 'frame':
+            self._frame_done(item['seq'], 'ready')
+            return
+
+        self._pair_done(item)
+        metrics.inc('frames_total', stage='detect')
+        metrics.observe('pipeline_latency_seconds', time.monotonic() - item['enqueued'])
+
+        with self._lock:
+            self.done += 1
+            self.last_latency = time.monotonic() - item['enqueued']
+            self.last_t_obs = event.retval['t_obs']
+
+        if self.on_result is not None:
+            self.on_result(event.retval)
+
+    # ---- состояние ----
+
+    def stats(self):
+        with self._lock:
+            inflight = list(self.inflight.values())
+            retries = list(self.retries)
+            ready = list(self.ready)
+
+        waiting = [item['enqueued'] for item in inflight + retries + ready]
+        with self.frames.mutex:
+            waiting.extend(enqueued for _, enqueued in self.frames.queue)
+
+        now = time.monotonic()
+        return {'depth': self.frames.qsize(),
+                'maxsize': self.frames.maxsize,
+                'inflight': len(inflight),
+                'retries': len(retries),
+                'ready': len(ready),
+                'done': self.done,
+                'failed': self.failed,
+                'requeued': self.requeued,
+                # сколько ждёт самый старый необработанный кадр
+                'queue_lag': now - min(waiting) if waiting else 0.,
+                'last_latency': self.last_latency,
+                # отставание обработанных данных от реального времени
+                'data_lag': (datetime.utcnow() - self.last_t_obs).total_seconds()
+                if self.last_t_obs is not None else None}
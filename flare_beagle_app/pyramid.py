@@ -0,0 +1,150 @@
+import time
+import cv2
+import numpy as np
+from fits_io import read_frame
+from image_processing import Preprocessor, detect_flare_series, flare_contours, flare_spots
+
+
+# Грубо-точный режим: разность кадров и поиск контуров сначала считаются на
+# прореженном в scale раз изображении; в полном разрешении обрабатываются
+# только окрестности (pad пикселей) найденных областей. Нормировка и порог
+# для вырезанных областей берутся из грубого прохода по всему кадру.
+
+
+def merge_boxes(boxes):
+    # объединяет пересекающиеся прямоугольники (x0, y0, x1, y1)
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return boxes
+
+
+class PyramidDetector:
+
+    def __init__(self, scale=4, pad=32, min_area=500):
+        self.scale = scale
+        self.pad = pad
+        self.min_area = min_area
+        self.coarse = Preprocessor(r_sun_offset=50 / scale)
+        self.fine = Preprocessor()
+        self.last_regions = []
+
+    def coarse_frame(self, path):
+        header, data = read_frame(path, step=self.scale)
+        thresh = self.coarse.process(data, header)
+        lo, hi = cv2.minMaxLoc(data)[:2]
+
+        return {'path': path,
+                'shape': (header['naxis2'], header['naxis1']),
+                'thresh': thresh,
+                'range': (lo, hi),
+                'threshold': self.coarse.last_threshold}
+
+    def regions(self, frame_one, frame_two):
+        cnts, _ = flare_contours(frame_one['thresh'], frame_two['thresh'],
+                                 self.min_area / self.scale ** 2)
+        h, w = frame_two['shape']
+        boxes = []
+        for cnt in cnts:
+            x, y, bw, bh = cv2.boundingRect(cnt)
+            boxes.append((max(x * self.scale - self.pad, 0),
+                          max(y * self.scale - self.pad, 0),
+                          min((x + bw) * self.scale + self.pad, w),
+                          min((y + bh) * self.scale + self.pad, h)))
+
+        return merge_boxes(boxes)
+
+    def fine_thresh(self, frame, roi):
+        header, data = read_frame(frame['path'], roi=roi)
+        return self.fine.process(data, header, norm_range=frame['range'], threshold=frame['threshold'])
+
+    def pair(self, frame_one, frame_two):
+        cnts = []
+        self.last_regions = self.regions(frame_one, frame_two)
+        for roi in self.last_regions:
+            thresh_one = self.fine_thresh(frame_one, roi)
+            thresh_two = self.fine_thresh(frame_two, roi)
+            roi_cnts, _ = flare_contours(thresh_one, thresh_two, self.min_area)
+            cnts.extend(cnt + np.array(roi[:2], dtype=cnt.dtype) for cnt in roi_cnts)
+
+        diff = np.zeros(frame_two['shape'], dtype=np.uint8)
+        cv2.drawContours(diff, cnts, -1, (255, 255, 255), -1)
+        return flare_spots(cnts), diff
+
+
+def detect_flare_pyramid(files, scale=4, pad=32, detector=None):
+    # аналог detect_flare_series: (spots, diff) для каждой пары соседних кадров
+    if detector is None:
+        detector = PyramidDetector(scale, pad)
+
+    prev = None
+    for path in files:
+        frame = detector.coarse_frame(path)
+        if prev is not None:
+            yield detector.pair(prev, frame)
+        prev = frame
+
+
+def pyramid_recall(files, scale=4, pad=32):
+    # сравнение с обработкой в полном разрешении: доля пар с вспышкой,
+    # найденных грубо-точным режимом, и доля пикселей вспышек - всего и
+    # внутри обработанных областей (вне их полная разность содержит и каймы
+    # пятен по всему диску, когда вспышка сдвигает нормировку кадра)
+    files = list(files)
+    detector = PyramidDetector(scale, pad)
+
+    t = time.perf_counter()
+    full = list(detect_flare_series(files))
+    full_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    coarse, regions = [], []
+    for result in detect_flare_pyramid(files, detector=detector):
+        coarse.append(result)
+        regions.append(detector.last_regions)
+    pyramid_time = time.perf_counter() - t
+
+    full_pairs = [i for i, (spots, _) in enumerate(full) if spots]
+    found_pairs = [i for i in full_pairs if coarse[i][0]]
+    full_pixels = sum(int(np.count_nonzero(diff)) for _, diff in full)
+    found_pixels = sum(int(np.count_nonzero(cv2.bitwise_and(f[1], c[1]))) for f, c in zip(full, coarse))
+    roi_pixels = 0
+    for (_, diff), boxes in zip(full, regions):
+        roi_pixels += sum(int(np.count_nonzero(diff[y0:y1, x0:x1])) for x0, y0, x1, y1 in boxes)
+
+    return {'scale': scale,
+            'pad': pad,
+            'pairs': len(full),
+            'flare_pairs': len(full_pairs),
+            'found_pairs': len(found_pairs),
+            'extra_pairs': sum(1 for i, (spots, _) in enumerate(coarse) if spots and not full[i][0]),
+            'pair_recall': len(found_pairs) / len(full_pairs) if full_pairs else 1.,
+            'pixel_recall': found_pixels / full_pixels if full_pixels else 1.,
+            'roi_pixel_recall': found_pixels / roi_pixels if roi_pixels else 1.,
+            'full_time': full_time,
+            'pyramid_time': pyramid_time}
+
+
+if __name__ == "__main__":
+    import sys
+    from catalog import get_catalog
+
+    # кадры выбираются из каталога: каталог с файлами и длина волны
+    catalog = get_catalog()
+    catalog.ensure_indexes()
+    catalog.scan(sys.argv[1] if len(sys.argv) > 1 else "downloads/2013_12s")
+    files = catalog.paths(int(sys.argv[2]) if len(sys.argv) > 2 else 171)
+    for scale in (4, 8):
+        print(pyramid_recall(files, scale=scale))
@@ -0,0 +1,224 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from database import storeDB, flare_beagleDB, bump_version
+import metrics
+
+log = logging.getLogger(__name__)
+
+# конфликт уникального ключа: при одновременных upsert одного ключа
+# проигравший получает эту ошибку, повтор становится обычным обновлением
+DUPLICATE_KEY = 11000
+
+# сводки по вспышкам: число, суммарные площадь и длительность, наибольшая
+# площадь в интервале; ключ - (granularity, wave, bucket), bucket - начало интервала
+GRANULARITIES = ('hour', 'day', 'month')
+
+# части даты, которые сохраняются в начале интервала
+BUCKET_PARTS = {'hour': ('year', 'month', 'day', 'hour'),
+                'day': ('year', 'month', 'day'),
+                'month': ('year', 'month')}
+
+
+def bucket_start(date, granularity):
+    parts = BUCKET_PARTS[granularity]
+    return datetime(date.year, date.month,
+                    date.day if 'day' in parts else 1,
+                    date.hour if 'hour' in parts else 0)
+
+
+class Repository:
+    # Запись состояния конвейера (storeDB.frames) и найденных вспышек
+    # (flare_beagleDB.flares). Записи копятся в буферах и уходят одним
+    # bulk_write на коллекцию - по batch штук или не реже раза в
+    # flush_every секунд. Все записи - upsert по естественному ключу, поэтому
+    # повторная обработка тех же кадров не создаёт дубликатов.
+
+    def __init__(self, store=None, db=None, batch=500, flush_every=5.):
+        store = store if store is not None else storeDB
+        db = db if db is not None else flare_beagleDB
+        self.frames = store.frames
+        self.flares = db.flares
+        self.stats = db.flare_stats
+        self.db = db
+        self.batch = batch
+        self.flush_every = flush_every
+
+        self._frames = []
+        self._flares = []
+        self._flare_docs = []
+        self._lock = threading.Lock()
+        self.flushed_at = time.monotonic()
+
+    def ensure_indexes(self):
+        self.frames.create_index([('wave', ASCENDING), ('series', ASCENDING), ('t_obs', ASCENDING)], unique=True)
+        self.frames.create_index([('wave', ASCENDING), ('state', ASCENDING), ('t_obs', ASCENDING)])
+        self.frames.create_index('path')
+        self.flares.create_index([('wave', ASCENDING), ('date_start', ASCENDING)], unique=True)
+        # индекс постраничной выдачи /api/events
+        self.flares.create_index([('date_start', ASCENDING), ('_id', ASCENDING), ('area', ASCENDING)])
+        self.stats.create_index([('granularity', ASCENDING), ('wave', ASCENDING), ('bucket', ASCENDING)],
+                                unique=True)
+
+    # ---- буферизованная запись ----
+
+    def frame_state(self, path, t_obs, wave, series, state, **extra):
+        key = {'wave': wave, 'series': series, 't_obs': t_obs}
+        doc = dict(extra, path=path, state=state, updated=datetime.utcnow())
+        self._add(self._frames, UpdateOne(key, {'$set': doc, '$setOnInsert': {'created': doc['updated']}},
+                                          upsert=True))
+
+    def frame_failed(self, path):
+        self._add(self._frames, UpdateOne({'path': path},
+                                          {'$set': {'state': 'failed', 'updated': datetime.utcnow()}}))
+
+    def detection(self, result, wave):
+        # result - словарь из pipeline.detect_pair
+        date_start, date_end = result['t_prev'], result['t_obs']
+        doc = {'date_end': date_end,
+               'duration': (date_end - date_start).total_seconds(),
+               'area': result['area'],
+               'spots': [list(spot) for spot in result['spots']],
+               'path': result['path_two'],
+               'updated': datetime.utcnow()}
+        doc.update(wave=wave, date_start=date_start)
+        self._add(self._flares, UpdateOne({'wave': wave, 'date_start': date_start}, {'$set': doc}, upsert=True),
+                  doc)
+
+    def _add(self, buffer, op, doc=None):
+        with self._lock:
+            buffer.append(op)
+            if doc is not None:
+                self._flare_docs.append(doc)
+            full = len(buffer) >= self.batch
+        if full or time.monotonic() - self.flushed_at >= self.flush_every:
+            self.flush()
+
+    @metrics.timed('mongo_write')
+    def flush(self):
+        # то, что не записалось, возвращается в начало буферов и уйдёт
+        # следующим flush
+        with self._lock:
+            frames, self._frames = self._frames, []
+            flares, self._flares = self._flares, []
+            docs, self._flare_docs = self._flare_docs, []
+            self.flushed_at = time.monotonic()
+
+        result = {'frames': None, 'flares': None}
+        try:
+            if frames:
+                # смены состояния одного кадра должны примениться по порядку
+                try:
+                    result['frames'] = self.frames.bulk_write(frames, ordered=True)
+                    frames = []
+                except BulkWriteError as e:
+                    # всё до ошибочной операции записано, после неё - не выполнялось
+                    errors = e.details['writeErrors'][:1]
+                    failed = errors[0]['index'] if errors else len(frames)
+                    frames = [frames[i] for i in self._retried(errors, 'frames')] + frames[failed + 1:]
+
+            if flares:
+                try:
+                    result['flares'] = self.flares.bulk_write(flares, ordered=False)
+                    upserted = result['flares'].upserted_ids
+                    retried = []
+                except BulkWriteError as e:
+                    # unordered: остальные операции выполнены
+                    upserted = [u['index'] for u in e.details['upserted']]
+                    retried = self._retried(e.details['writeErrors'], 'flares')
+
+                new = [docs[i] for i in upserted]
+                flares, docs = [flares[i] for i in retried], [docs[i] for i in retried]
+                # в сводки и версию для веб-кэша попадают только новые вспышки:
+                # повторная запись уже известной их не меняет
+                if new:
+                    try:
+                        self._update_stats(new)
+                    finally:
+                        bump_version(self.db, name='flares')
+        except Exception:
+            # если упала запись сводок, их чинит rebuild_stats
+            log.exception('flush failed, requeued %d frame and %d flare writes', len(frames), len(flares))
+            raise
+        finally:
+            if frames or flares:
+                with self._lock:
+                    self._frames[:0] = frames
+                    self._flares[:0] = flares
+                    self._flare_docs[:0] = docs
+
+        return result
+
+    def _retried(self, errors, collection):
+        # индексы операций, которые стоит повторить; остальные ошибки при
+        # повторе не исчезнут - такие записи отбрасываются
+        retried = []
+        for error in errors:
+            if error['code'] == DUPLICATE_KEY:
+                retried.append(error['index'])
+            else:
+                log.error('%s write dropped: %s', collection, error['errmsg'])
+        return retried
+
+    def _update_stats(self, docs):
+        inc = {}
+        for doc in docs:
+            for granularity in GRANULARITIES:
+                key = (granularity, doc['wave'], bucket_start(doc['date_start'], granularity))
+                count, area, duration, max_area = inc.get(key, (0, 0, 0., 0))
+                inc[key] = (count + 1, area + doc['area'], duration + doc['duration'], max(max_area, doc['area']))
+
+        ops = [UpdateOne({'granularity': granularity, 'wave': wave, 'bucket': bucket},
+                         {'$inc': {'count': count, 'area': area, 'duration': duration},
+                          '$max': {'max_area': max_area}},
+                         upsert=True)
+               for (granularity, wave, bucket), (count, area, duration, max_area) in inc.items()]
+        if ops:
+            self.stats.bulk_write(ops, ordered=False)
+
+    def rebuild_stats(self, granularity, date_start=None, date_end=None):
+        # пересчёт сводок из flares; интервал [date_start, date_end) должен
+        # совпадать с границами интервалов сводки
+        match = {}
+        if date_start is not None:
+            match.setdefault('date_start', {})['$gte'] = date_start
+        if date_end is not None:
+            match.setdefault('date_start', {})['$lt'] = date_end
+
+        operators = {'year': '$year', 'month': '$month', 'day': '$dayOfMonth', 'hour': '$hour'}
+        parts = {part: {operators[part]: '$date_start'} for part in BUCKET_PARTS[granularity]}
+        pipeline = [{'$match': match},
+                    {'$group': {'_id': {'wave': '$wave', 'bucket': {'$dateFromParts': parts}},
+                                'count': {'$sum': 1},
+                                'area': {'$sum': '$area'},
+                                'duration': {'$sum': '$duration'},
+                                'max_area': {'$max': '$area'}}}]
+
+        stale = {'granularity': granularity}
+        if match:
+            stale['bucket'] = match['date_start']
+        self.stats.delete_many(stale)
+
+        ops = []
+        for row in self.flares.aggregate(pipeline, allowDiskUse=True):
+            key = {'granularity': granularity, 'wave': row['_id']['wave'], 'bucket': row['_id']['bucket']}
+            doc = dict(key, count=row['count'], area=row['area'], duration=row['duration'],
+                       max_area=row['max_area'])
+            ops.append(ReplaceOne(key, doc, upsert=True))
+            if len(ops) >= self.batch:
+                self.stats.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            self.stats.bulk_write(ops, ordered=False)
+
+    # ---- чтение ----
+
+    def last_frame(self, wave, series, state=None):
+        self.flush()
+        query = {'wave': wave, 'series': series}
+        if state is not None:
+            query['state'] = state
+        return self.frames.find_one(query, sort=[('t_obs', DESCENDING)])
@@ -0,0 +1,150 @@
+import math
+import cv2
+from catalog import get_catalog, parse_t_obs
+from fits_io import read_frame, read_header
+from image_processing import Preprocessor, smooth_thresh
+from pyramid import merge_boxes
+from sunspot_table import SunspotTable
+
+
+# Дифференциальное вращение (Snodgrass & Ulrich 1990), град/сутки,
+# минус орбитальное движение Земли - синодическая скорость
+ROT_A, ROT_B, ROT_C = 14.713, -2.396, -1.787
+EARTH_RATE = 0.9856
+
+
+def rotation_rate(lat):
+    sin2 = math.sin(lat) ** 2
+    return ROT_A + ROT_B * sin2 + ROT_C * sin2 ** 2 - EARTH_RATE
+
+
+def rotate_point(x, y, crpix, r_sun, days):
+    # новое положение точки диска через days суток; None, если точка ушла за лимб.
+    # Наклон оси (B0, P) не учитывается: ось вращения считается вертикальной
+    px, py = (x - crpix[0]) / r_sun, (y - crpix[1]) / r_sun
+    lat = math.asin(max(-1., min(1., py)))
+    cos_lat = math.cos(lat)
+    if cos_lat == 0:
+        return x, y
+
+    lon = math.asin(max(-1., min(1., px / cos_lat)))
+    lon += math.radians(rotation_rate(lat) * days)
+    if abs(lon) > math.pi / 2:
+        return None
+
+    return crpix[0] + r_sun * cos_lat * math.sin(lon), y
+
+
+class RoiTracker:
+    # Отслеживает области интереса от кадра к кадру: между кадрами
+    # прямоугольники сдвигаются по дифференциальному вращению, обрабатываются
+    # только они (из FITS читаются только их срезы). Полный диск
+    # пересматривается раз в rescan_every кадров, нормировка и порог для
+    # областей берутся с последнего полного прохода.
+
+    def __init__(self, rescan_every=50, pad=64, min_area=150, preprocessor=None):
+        self.rescan_every = rescan_every
+        self.pad = pad
+        self.min_area = min_area
+        self.preprocessor = preprocessor or Preprocessor()
+
+        self.regions = []
+        self.t = None
+        self.since_scan = None
+        self.norm_range = None
+        self.threshold = None
+
+        self.pixels_processed = 0
+        self.pixels_total = 0
+
+    def advance(self, t, header):
+        if self.t is None:
+            self.t = t
+            return
+
+        days = (t - self.t).total_seconds() / 86400.
+        crpix = (header['crpix1'], header['crpix2'])
+        r_sun = header['r_sun']
+
+        moved = []
+        for x0, y0, x1, y1 in self.regions:
+            center = rotate_point((x0 + x1) / 2, (y0 + y1) / 2, crpix, r_sun, days)
+            if center is None:
+                continue
+            dx = int(round(center[0] - (x0 + x1) / 2))
+            moved.append((x0 + dx, y0, x1 + dx, y1))
+
+        self.regions = moved
+        self.t = t
+
+    def _clip(self, box, shape):
+        h, w = shape
+        x0, y0, x1, y1 = box
+        return max(int(x0), 0), max(int(y0), 0), min(int(x1), w), min(int(y1), h)
+
+    def _sunspots(self, thresh, offset=(0, 0)):
+        cnts, _ = cv2.findContours(smooth_thresh(thresh), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                   offset=offset)
+        return SunspotTable.from_contours(cnts, self.min_area)
+
+    def _boxes(self, sunspots, shape):
+        return [self._clip((x - self.pad, y - self.pad, x + w + self.pad, y + h + self.pad), shape)
+                for x, y, w, h in sunspots.bboxes.tolist()]
+
+    def full_scan(self, path):
+        header, data = read_frame(path)
+        thresh = self.preprocessor.process(data, header)
+        self.norm_range = cv2.minMaxLoc(data)[:2]
+        self.threshold = self.preprocessor.last_threshold
+        self.pixels_processed += data.size
+
+        sunspots = self._sunspots(thresh)
+        self.regions = merge_boxes(self._boxes(sunspots, data.shape))
+        self.since_scan = 0
+
+        return sunspots
+
+    def roi_scan(self, path, shape):
+        sunspots = []
+        regions = []
+        for roi in self.regions:
+            roi = self._clip(roi, shape)
+            if roi[0] >= roi[2] or roi[1] >= roi[3]:
+                continue
+
+            header, data = read_frame(path, roi=roi)
+            thresh = self.preprocessor.process(data, header, norm_range=self.norm_range,
+                                               threshold=self.threshold)
+            self.pixels_processed += data.size
+
+            found = self._sunspots(thresh, offset=roi[:2])
+            sunspots.append(found)
+            regions.extend(self._boxes(found, shape))
+
+        # пропавшие области больше не отслеживаются до следующего полного прохода
+        self.regions = merge_boxes(regions)
+        self.since_scan += 1
+
+        return SunspotTable.concat(sunspots)
+
+    def process(self, path):
+        header = read_header(path)
+        shape = (header['naxis2'], header['naxis1'])
+        self.pixels_total += shape[0] * shape[1]
+        self.advance(parse_t_obs(header['t_obs']), header)
+
+        if self.since_scan is None or self.since_scan + 1 >= self.rescan_every:
+            return self.full_scan(path)
+
+        return self.roi_scan(path, shape)
+
+    def track(self, files):
+        for path in files:
+            yield path, self.process(path)
+
+    def track_range(self, wave, date_start=None, date_end=None, series=None, catalog=None):
+        # кадры интервала из каталога в порядке t_obs
+        return self.track((catalog or get_catalog()).paths(wave, date_start, date_end, series))
+
+    def processed_fraction(self):
+        return self.pixels_processed / self.pixels_total if self.pixels_total else 0.
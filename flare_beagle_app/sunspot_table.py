@@ -0,0 +1,183 @@
+import numpy as np
+from image_processing import _segment_argext, close_spot_pairs
+
+
+# Пятна кадра в виде набора массивов вместо словарей {'center', 'cnt'}:
+# все контуры лежат в одном массиве точек points (N, 2), контур пятна i -
+# points[offsets[i]:offsets[i] + lengths[i]]. Центры, площади, охватывающие
+# прямоугольники и индексы крайних точек (min x, max x, min y, max y)
+# считаются одним проходом по всем точкам сразу.
+
+_INT64 = ('areas', 'offsets', 'lengths')
+_INT32 = ('centers', 'bboxes', 'extremes')
+
+
+class SunspotTable:
+
+    def __init__(self, points, offsets, lengths, centers, areas, bboxes, extremes):
+        self.points = points
+        self.offsets = offsets
+        self.lengths = lengths
+        self.centers = centers
+        self.areas = areas
+        self.bboxes = bboxes
+        self.extremes = extremes
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def from_contours(cls, cnts, min_area=0):
+        # cnts - как из cv2.findContours; пятна меньше min_area отбрасываются
+        cnts = [cnt.reshape(-1, 2) for cnt in cnts]
+        if len(cnts) == 0:
+            return cls.empty()
+
+        lengths = np.array([len(cnt) for cnt in cnts], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        points = np.concatenate(cnts).astype(np.int32)
+
+        m00, m10, m01 = contour_moments(points, offsets, lengths)
+        keep = np.flatnonzero(m00 >= min_area) if min_area > 0 else np.arange(len(cnts))
+        if len(keep) == 0:
+            return cls.empty()
+        if len(keep) < len(cnts):
+            lengths = lengths[keep]
+            starts = offsets[keep]
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            points = points[np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)]
+            m00, m10, m01 = m00[keep], m10[keep], m01[keep]
+
+        # как get_sunspot: int(m10 / m00); для вырожденных контуров (m00 = 0),
+        # на которых get_sunspot падает, - среднее точек
+        centers = np.empty((len(lengths), 2), dtype=np.int32)
+        nonzero = m00 != 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            centers[:, 0] = np.where(nonzero, np.trunc(m10 / m00), 0)
+            centers[:, 1] = np.where(nonzero, np.trunc(m01 / m00), 0)
+        if not nonzero.all():
+            mean = np.add.reduceat(points.astype(np.int64), offsets) // lengths[:, None]
+            centers[~nonzero] = mean[~nonzero]
+
+        x, y = points[:, 0], points[:, 1]
+        x_min, left = _segment_argext(x, offsets, lengths, np.minimum)
+        x_max, right = _segment_argext(x, offsets, lengths, np.maximum)
+        y_min, top = _segment_argext(y, offsets, lengths, np.minimum)
+        y_max, bottom = _segment_argext(y, offsets, lengths, np.maximum)
+
+        bboxes = np.stack((x_min, y_min, x_max - x_min + 1, y_max - y_min + 1), axis=1).astype(np.int32)
+        extremes = np.stack((left, right, top, bottom), axis=1).astype(np.int32)
+
+        return cls(points, offsets.astype(np.int64), lengths, centers, m00, bboxes, extremes)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 2), np.int32), np.zeros(0, np.int64), np.zeros(0, np.int64),
+                   np.zeros((0, 2), np.int32), np.zeros(0, np.float64), np.zeros((0, 4), np.int32),
+                   np.zeros((0, 4), np.int32))
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [t for t in tables if len(t)]
+        if len(tables) == 0:
+            return cls.empty()
+
+        shift = np.cumsum([0] + [len(t.points) for t in tables[:-1]])
+        return cls(np.concatenate([t.points for t in tables]),
+                   np.concatenate([t.offsets + s for t, s in zip(tables, shift)]),
+                   np.concatenate([t.lengths for t in tables]),
+                   np.concatenate([t.centers for t in tables]),
+                   np.concatenate([t.areas for t in tables]),
+                   np.concatenate([t.bboxes for t in tables]),
+                   np.concatenate([t.extremes for t in tables]))
+
+    # ---- совместимость со словарями ----
+
+    def contour(self, i):
+        start = self.offsets[i]
+        return self.points[start:start + self.lengths[i]].reshape(-1, 1, 2)
+
+    def sunspot(self, i):
+        return {'center': (int(self.centers[i, 0]), int(self.centers[i, 1])), 'cnt': self.contour(i)}
+
+    def to_dict(self):
+        return {i: self.sunspot(i) for i in range(len(self))}
+
+    def close_spots(self, max_dist=500, max_gap=15):
+        # то же, что get_close_spots(self.to_dict())
+        return close_spot_pairs(self.centers, self.points, self.offsets, self.lengths, max_dist, max_gap)
+
+    # ---- один буфер: для memmap/общей памяти между процессами ----
+
+    def _layout(self):
+        n, total = len(self), len(self.points)
+        sizes = [('header', 16)] + [(name, 8 * n) for name in _INT64] + \
+                [('centers', 8 * n), ('bboxes', 16 * n), ('extremes', 16 * n), ('points', 8 * total)]
+        return sizes
+
+    @property
+    def nbytes(self):
+        return sum(size for _, size in self._layout())
+
+    def pack(self, out=None):
+        # все массивы подряд в одном байтовом буфере (out - например, срез memmap)
+        if out is None:
+            out = np.empty(self.nbytes, dtype=np.uint8)
+
+        pos = 0
+        for name, size in self._layout():
+            if name == 'header':
+                value = np.array([len(self), len(self.points)], dtype=np.int64)
+            else:
+                value = getattr(self, name)
+            out[pos:pos + size] = np.ascontiguousarray(value).view(np.uint8).reshape(-1)
+            pos += size
+
+        return out
+
+    @classmethod
+    def unpack(cls, buf):
+        # массивы - представления buf, без копирования
+        buf = np.asarray(buf).view(np.uint8)
+        n, total = buf[:16].view(np.int64)
+        shapes = {'areas': (np.float64, (n,)), 'offsets': (np.int64, (n,)), 'lengths': (np.int64, (n,)),
+                  'centers': (np.int32, (n, 2)), 'bboxes': (np.int32, (n, 4)),
+                  'extremes': (np.int32, (n, 4)), 'points': (np.int32, (total, 2))}
+
+        arrays = {}
+        pos = 16
+        for name in _INT64 + _INT32 + ('points',):
+            dtype, shape = shapes[name]
+            size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            arrays[name] = buf[pos:pos + size].view(dtype).reshape(shape)
+            pos += size
+
+        return cls(**arrays)
+
+
+def contour_moments(points, offsets, lengths):
+    # m00, m10, m01 всех контуров сразу, с той же арифметикой, что и
+    # cv2.moments для целочисленного контура: суммы по рёбрам точные (целые),
+    # затем умножение на +-1/2 и +-1/6 в double по знаку ориентированной площади
+    prev = np.arange(len(points)) - 1
+    prev[offsets] = offsets + lengths - 1
+
+    x = points[:, 0].astype(np.int64)
+    y = points[:, 1].astype(np.int64)
+    x_1, y_1 = x[prev], y[prev]
+
+    dxy = x_1 * y - x * y_1
+    a00 = np.add.reduceat(dxy, offsets).astype(np.float64)
+    a10 = np.add.reduceat(dxy * (x_1 + x), offsets).astype(np.float64)
+    a01 = np.add.reduceat(dxy * (y_1 + y), offsets).astype(np.float64)
+
+    sign = np.where(a00 > 0, 1., -1.)
+    db1_2 = sign * 0.5
+    db1_6 = sign * 0.16666666666666666666666666666667
+    degenerate = np.abs(a00) <= np.finfo(np.float32).eps
+
+    m00 = np.where(degenerate, 0., a00 * db1_2)
+    m10 = np.where(degenerate, 0., a10 * db1_6)
+    m01 = np.where(degenerate, 0., a01 * db1_6)
+
+    return m00, m10, m01
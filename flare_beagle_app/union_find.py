@@ -0,0 +1,40 @@
+class UnionFind:
+    # непересекающиеся множества со сжатием путей и объединением по рангу
+
+    def __init__(self, n=0):
+        self.parent = list(range(n))
+        self.rank = [0] * n
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add(self):
+        self.parent.append(len(self.parent))
+        self.rank.append(0)
+        return len(self.parent) - 1
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+
+        if self.rank[a] < self.rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if self.rank[a] == self.rank[b]:
+            self.rank[a] += 1
+
+        return a
+
+    def roots(self):
+        return [x for x in range(len(self.parent)) if self.parent[x] == x]
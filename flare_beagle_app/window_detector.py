@@ -0,0 +1,93 @@
+import cv2
+import numpy as np
+from accumulator import ContourAccumulator
+from catalog import parse_t_obs
+from fits_io import iter_frames
+from image_processing import Preprocessor, find_flare
+import metrics
+
+
+# Обнаружение вспышек по скользящему фону вместо разности двух соседних
+# кадров: маска нового кадра сравнивается с фоном из последних window
+# кадров (число или timedelta), после чего кадр добавляется в окно. Фон:
+#   'median' - побитовая медиана масок окна (пиксель включён, если он
+#              включён больше чем в половине кадров); счётчики и упакованные
+#              маски окна хранит ContourAccumulator;
+#   'ema'    - экспоненциальное среднее масок с весом alpha, порог 1/2.
+# Обновление в обоих случаях - O(1) кадров на шаг, независимо от window.
+# Результат - тот же (spots, diff), что у find_flare.
+
+BACKGROUND_MODES = ('median', 'ema')
+
+
+class WindowDetector:
+
+    def __init__(self, shape=None, window=10, mode='median', alpha=0.2, min_area=500):
+        if mode not in BACKGROUND_MODES:
+            raise ValueError('unknown background mode: %s' % mode)
+        self.window = window
+        self.mode = mode
+        self.alpha = alpha
+        self.min_area = min_area
+        self.frames = 0
+        self.shape = None
+        self.acc = None
+        self.ema = None
+        self.background = None
+        if shape is not None:
+            self._init(shape)
+
+    def _init(self, shape):
+        self.shape = tuple(shape)
+        self.background = np.zeros(self.shape, dtype=np.uint8)
+        if self.mode == 'median':
+            self.acc = ContourAccumulator(self.shape, self.window)
+        else:
+            self.ema = np.zeros(self.shape, dtype=np.float32)
+
+    def _background(self):
+        if self.mode == 'median':
+            # counts * 2 > n: больше половины кадров окна
+            cv2.compare(self.acc.counts, len(self.acc.ring) / 2, cv2.CMP_GT, dst=self.background)
+        else:
+            cv2.compare(self.ema, 127.5, cv2.CMP_GE, dst=self.background)
+        return self.background
+
+    def _add(self, thresh, t):
+        if self.mode == 'median':
+            self.acc.update(thresh, t)
+        elif self.frames == 0:
+            self.ema[:] = thresh
+        else:
+            cv2.accumulateWeighted(thresh, self.ema, self.alpha)
+        self.frames += 1
+
+    @metrics.timed('window_detect')
+    def update(self, thresh, t=None):
+        # thresh - маска кадра из Preprocessor; для первого кадра фона ещё
+        # нет и возвращается None, дальше - (spots, diff)
+        if self.shape is None:
+            self._init(thresh.shape)
+
+        result = None
+        if self.frames > 0:
+            result = find_flare(self._background(), thresh, self.min_area)
+        self._add(thresh, t)
+
+        return result
+
+
+def detect_flare_window(files, window=10, mode='median', alpha=0.2, preprocessor=None, detector=None):
+    # аналог detect_flare_series: (spots, diff) для каждого кадра, начиная со второго;
+    # при window=1 совпадает с ним
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+    if detector is None:
+        detector = WindowDetector(window=window, mode=mode, alpha=alpha)
+
+    thresh = None
+    for _, header, data in iter_frames(files):
+        thresh = preprocessor.process(data, header, out=thresh)
+        result = detector.update(thresh, parse_t_obs(header['t_obs']))
+        if result is not None:
+            yield result
@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    # LRU-кэш готовых ответов с временем жизни ttl секунд. Если задан backend
+    # (общий для нескольких процессов, интерфейс redis: get(key), set(key,
+    # value, ex=ttl)), промахи локального кэша ищутся в нём.
+
+    def __init__(self, maxsize=256, ttl=30, backend=None, prefix='flare_beagle:'):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.prefix = prefix
+        self.items = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            item = self.items.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > now:
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.items[key]
+
+        value = self._backend_get(key)
+        if value is not None:
+            self._put(key, value)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value
+
+    def set(self, key, value):
+        self._put(key, value)
+        if self.backend is not None:
+            self.backend.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def _put(self, key, value):
+        with self._lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def _backend_get(self, key):
+        if self.backend is None:
+            return None
+        value = self.backend.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def clear(self):
+        with self._lock:
+            self.items.clear()
+
+
+def make_cache(config):
+    backend = None
+    if config.get('CACHE_REDIS_URL'):
+        # redis нужен только при общем кэше
+        import redis
+        backend = redis.Redis.from_url(config['CACHE_REDIS_URL'])
+
+    return ResponseCache(config.get('CACHE_SIZE', 256), config.get('CACHE_TTL', 30), backend)
+
+
+class Version:
+    # Версия коллекции flares: документ {_id: 'flares', version, updated} в
+    # коллекции meta, её увеличивает детектор при записи вспышек. Версия
+    # входит в ETag и ключ кэша, поэтому запись сама делает их устаревшими.
+    # Чтобы не ходить в базу на каждый запрос, версия перечитывается не чаще
+    # раза в refresh секунд.
+
+    def __init__(self, collection, name='flares', refresh=1.):
+        self.collection = collection
+        self.name = name
+        self.refresh = refresh
+        self.value = None
+        self.read_at = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.value is None or now - self.read_at >= self.refresh:
+            doc = self.collection.find_one({'_id': self.name}) or {}
+            self.value = (doc.get('version', 0), doc.get('updated'))
+            self.read_at = now
+        return self.value
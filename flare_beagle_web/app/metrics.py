@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+from flask import Response, g, request
+from app import app
+
+# в конец пути: у flare_beagle_app свой database.py, он не должен перекрывать веб-часть
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'flare_beagle_app'))
+from metrics import Registry
+
+
+# /metrics веб-части в формате Prometheus: длительность запросов по
+# обработчикам, ответы по кодам, попадания в кэш. Корзины и вывод - общий
+# Registry из flare_beagle_app/metrics.py, как у процесса планировщика.
+# Если задан METRICS_TEXTFILE (его пишет планировщик), его содержимое
+# отдаётся тем же ответом. Включается METRICS_ENABLED в конфиге.
+
+registry = Registry()
+registry.help.update({
+    'web_requests_total': 'Responses by endpoint and status',
+    'web_request_seconds': 'Duration of requests by endpoint',
+    'web_cache_hits_total': 'Responses served from the cache',
+    'web_cache_misses_total': 'Responses not found in the cache',
+})
+
+
+def render(cache=None):
+    text = registry.render()
+
+    textfile = app.config.get('METRICS_TEXTFILE')
+    if textfile and os.path.exists(textfile):
+        with open(textfile) as f:
+            text += f.read()
+
+    return text
+
+
+def init_metrics(cache=None):
+    if cache is not None:
+        def collect():
+            # счётчики кэша ведёт сам кэш, здесь только снимок перед выводом
+            registry.counters[('web_cache_hits_total', ())] = cache.hits
+            registry.counters[('web_cache_misses_total', ())] = cache.misses
+        registry.collectors.append(collect)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record(response):
+        start = g.pop('metrics_start', None)
+        if start is not None and request.endpoint != 'metrics':
+            endpoint = request.endpoint or 'unknown'
+            registry.inc('web_requests_total', endpoint=endpoint, status=response.status_code)
+            registry.observe('web_request_seconds', time.perf_counter() - start, endpoint=endpoint)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(render(cache), mimetype='text/plain; version=0.0.4')
@@ -1,31 +1,287 @@
-from flask import jsonify
-from app import app
-from flask import request
-from flask_pymongo import PyMongo
-from bson.json_util import dumps
-from bson.json_util import loads
-
-
-mongo = PyMongo(app)
-
-@app.route('/')
-@app.route('/test', methods=['GET'])
-def ping_pong():
-    return jsonify('test!')
-
-@app.route('/index')
-def index():
-    pass
-
-@app.route('/api/events', methods=['GET'])
-def get_events():
-    # page = request.args.get('page')
-    # print(page)
-    # per_page = request.args.get('per_page')
-    events = mongo.db.flares.find({}, {'_id': 0})
-    # events = mongo.db.flares.find({}, {'_id': 0}).limit(int(per_page)).skip(page-1 * per_page)
-
-    return jsonify({
-        'status': 'success',
-        'events': loads(dumps(events))
-    })
\ No newline at end of file
+import base64
+import csv
+import hashlib
+import io
+import json
+import zlib
+from datetime import datetime
+from bson import ObjectId
+from flask import jsonify
+from app import app
+from flask import request, Response, stream_with_context
+from flask_pymongo import PyMongo
+from pymongo import ASCENDING
+from bson.json_util import dumps
+from bson.json_util import loads
+from app.cache import Version, make_cache
+from app.metrics import init_metrics
+
+
+mongo = PyMongo(app)
+cache = make_cache(app.config)
+flares_version = Version(mongo.db.meta)
+if app.config.get('METRICS_ENABLED'):
+    init_metrics(cache)
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+EXPORT_FIELDS = ['date_start', 'date_end', 'area', 'ap', 'duration']
+EXPORT_BATCH = 1000
+EXPORT_CHUNK = 1 << 16
+
+# события отдаются по возрастанию (date_start, _id); area в индексе нужна,
+# чтобы фильтр по площади проверялся по ключам индекса, без чтения документов
+EVENTS_INDEX = [('date_start', ASCENDING), ('_id', ASCENDING), ('area', ASCENDING)]
+
+_indexes_ready = False
+
+
+def ensure_indexes():
+    global _indexes_ready
+    if not _indexes_ready:
+        mongo.db.flares.create_index(EVENTS_INDEX)
+        _indexes_ready = True
+
+
+def encode_cursor(event):
+    return base64.urlsafe_b64encode(dumps([event['date_start'], event['_id']]).encode()).decode()
+
+
+def decode_cursor(value):
+    date_start, _id = loads(base64.urlsafe_b64decode(value.encode()))
+    return date_start, _id
+
+
+def serialize(event):
+    event = dict(event)
+    if '_id' in event:
+        event['id'] = str(event.pop('_id'))
+    for key, value in event.items():
+        if isinstance(value, datetime):
+            event[key] = value.isoformat()
+        elif isinstance(value, ObjectId):
+            event[key] = str(value)
+    return event
+
+
+def events_query(args):
+    # фильтры: start/end по date_start (ISO), min_area/max_area; after - курсор
+    # с последнего события предыдущей страницы
+    conditions = []
+
+    date_start = {}
+    if 'start' in args:
+        date_start['$gte'] = datetime.fromisoformat(args['start'])
+    if 'end' in args:
+        date_start['$lte'] = datetime.fromisoformat(args['end'])
+    if date_start:
+        conditions.append({'date_start': date_start})
+
+    area = {}
+    if 'min_area' in args:
+        area['$gte'] = float(args['min_area'])
+    if 'max_area' in args:
+        area['$lte'] = float(args['max_area'])
+    if area:
+        conditions.append({'area': area})
+
+    if 'after' in args:
+        last_date, last_id = decode_cursor(args['after'])
+        conditions.append({'$or': [{'date_start': {'$gt': last_date}},
+                                   {'date_start': last_date, '_id': {'$gt': last_id}}]})
+
+    if len(conditions) == 0:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+
+def events_limit(args):
+    limit = int(args.get('limit', DEFAULT_LIMIT))
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, MAX_LIMIT)
+
+
+@app.route('/')
+@app.route('/test', methods=['GET'])
+def ping_pong():
+    return jsonify('test!')
+
+@app.route('/index')
+def index():
+    pass
+
+def events_etag(path, args, version):
+    params = json.dumps([path] + sorted(args.items(multi=True)))
+    return '%d-%s' % (version, hashlib.sha1(params.encode()).hexdigest()[:16])
+
+
+def cached_json(build):
+    # ETag = версия flares + путь и параметры запроса: пока детектор не записал
+    # новые вспышки, повторный запрос отвечается 304 без обращения к базе.
+    # build() строит ответ или бросает ValueError/TypeError на плохие параметры
+    version, updated = flares_version.get()
+    etag = events_etag(request.path, request.args, version)
+
+    response = app.response_class(mimetype='application/json')
+    response.set_etag(etag)
+    if updated is not None:
+        response.last_modified = updated
+    response.cache_control.no_cache = True
+    if request.if_none_match.contains(etag):
+        response.status_code = 304
+        return response
+
+    body = cache.get(etag)
+    if body is None:
+        try:
+            body = json.dumps(build())
+        except (ValueError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        cache.set(etag, body)
+
+    response.set_data(body)
+    return response.make_conditional(request)
+
+
+def events_page(args):
+    query = events_query(args)
+    limit = events_limit(args)
+
+    ensure_indexes()
+    # на один документ больше - чтобы знать, есть ли следующая страница
+    events = list(mongo.db.flares.find(query).sort(EVENTS_INDEX[:2]).limit(limit + 1))
+    next_cursor = encode_cursor(events[limit - 1]) if len(events) > limit else None
+
+    return {
+        'status': 'success',
+        'events': [serialize(event) for event in events[:limit]],
+        'next': next_cursor
+    }
+
+
+@app.route('/api/events', methods=['GET'])
+def get_events():
+    return cached_json(lambda: events_page(request.args))
+
+
+def events_summary(args):
+    # сводки из flare_stats (их ведёт детектор): granularity=hour|day|month,
+    # start/end по началу интервала, wave - одна длина волны, иначе сумма по всем
+    granularity = args.get('granularity', 'day')
+    if granularity not in ('hour', 'day', 'month'):
+        raise ValueError('granularity must be hour, day or month')
+
+    match = {'granularity': granularity}
+    if 'wave' in args:
+        match['wave'] = int(args['wave'])
+    bucket = {}
+    if 'start' in args:
+        bucket['$gte'] = datetime.fromisoformat(args['start'])
+    if 'end' in args:
+        bucket['$lte'] = datetime.fromisoformat(args['end'])
+    if bucket:
+        match['bucket'] = bucket
+
+    rows = mongo.db.flare_stats.aggregate([
+        {'$match': match},
+        {'$group': {'_id': '$bucket',
+                    'count': {'$sum': '$count'},
+                    'area': {'$sum': '$area'},
+                    'duration': {'$sum': '$duration'},
+                    'max_area': {'$max': '$max_area'}}},
+        {'$sort': {'_id': 1}}])
+
+    return {
+        'status': 'success',
+        'granularity': granularity,
+        'buckets': [{'bucket': row['_id'].isoformat(),
+                     'count': row['count'],
+                     'area': row['area'],
+                     'duration': row['duration'],
+                     'max_area': row['max_area']} for row in rows]
+    }
+
+
+@app.route('/api/events/summary', methods=['GET'])
+def get_events_summary():
+    return cached_json(lambda: events_summary(request.args))
+
+
+def export_fields(args):
+    if 'fields' not in args:
+        return EXPORT_FIELDS
+    fields = [f for f in args['fields'].split(',') if f]
+    if len(fields) == 0 or any(f.startswith('$') for f in fields):
+        raise ValueError('bad fields')
+    return fields
+
+
+def export_lines(cursor, fields, fmt):
+    # события превращаются в строки по одному, в памяти только текущая пачка курсора
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(fields)
+        for event in cursor:
+            event = serialize(event)
+            writer.writerow([event.get(f, '') for f in fields])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    else:
+        for event in cursor:
+            yield json.dumps(serialize(event)) + '\n'
+
+
+def export_chunks(lines, compress):
+    # строки собираются в куски по EXPORT_CHUNK байт; gzip - потоковый (wbits=31)
+    gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK:
+            data = ''.join(chunk).encode()
+            yield gzip.compress(data) if gzip else data
+            chunk = []
+            size = 0
+
+    data = ''.join(chunk).encode()
+    if gzip:
+        yield gzip.compress(data) + gzip.flush()
+    elif data:
+        yield data
+
+
+@app.route('/api/events/export', methods=['GET'])
+def export_events():
+    # выгрузка без ограничения на число событий: format=ndjson|csv, фильтры как
+    # у /api/events, fields - список полей через запятую (id - идентификатор)
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        if fmt not in ('ndjson', 'csv'):
+            raise ValueError('format must be ndjson or csv')
+        query = events_query(request.args)
+        fields = export_fields(request.args)
+    except (ValueError, TypeError) as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    ensure_indexes()
+    projection = {f: 1 for f in fields if f != 'id'}
+    projection['_id'] = 'id' in fields
+    cursor = mongo.db.flares.find(query, projection).sort(EVENTS_INDEX[:2]).batch_size(EXPORT_BATCH)
+
+    compress = 'gzip' in request.accept_encodings
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(export_chunks(export_lines(cursor, fields, fmt), compress)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=flares.%s' % fmt
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
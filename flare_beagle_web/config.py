@@ -1,24 +1,33 @@
-import os
-
-class Config(object):
-    DEBUG = False
-
-    CSRF_ENABLED = True
-    # SECRET_KEY = 'YOUR_RANDOM_SECRET_KEY'
-    SECRET_KEY = os.environ.get('SECRET>_KEY') or "my_secret_key"
-
-    MONGODB_DB = 'flare_beagleDB'
-    MONGODB_HOST = '0.0.0.0'
-    MONGODB_PORT = 27017
-    ENV = 'development'
-    # SERVER_NAME = '0.0.0.0:5000'
-    SERVER_NAME = 'localhost:5000'
-    MONGO_URI = "mongodb://localhost:27017/flare_beagleDB"
-
-
-class ProductionConfig(Config):
-    DEBUG = False
-
-class DevelopmentConfig(Config):
-    DEVELOPMENT = True
+import os
+
+class Config(object):
+    DEBUG = False
+
+    CSRF_ENABLED = True
+    # SECRET_KEY = 'YOUR_RANDOM_SECRET_KEY'
+    SECRET_KEY = os.environ.get('SECRET>_KEY') or "my_secret_key"
+
+    MONGODB_DB = 'flare_beagleDB'
+    MONGODB_HOST = '0.0.0.0'
+    MONGODB_PORT = 27017
+    ENV = 'development'
+    # SERVER_NAME = '0.0.0.0:5000'
+    SERVER_NAME = 'localhost:5000'
+    MONGO_URI = "mongodb://localhost:27017/flare_beagleDB"
+
+    # кэш ответов /api/events; CACHE_REDIS_URL - общий кэш для нескольких процессов
+    CACHE_SIZE = 256
+    CACHE_TTL = 30
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+
+    # /metrics; METRICS_TEXTFILE - файл метрик процесса планировщика
+    METRICS_ENABLED = os.environ.get('FLARE_BEAGLE_METRICS', '') not in ('', '0', 'false')
+    METRICS_TEXTFILE = os.environ.get('FLARE_BEAGLE_METRICS_TEXTFILE')
+
+
+class ProductionConfig(Config):
+    DEBUG = False
+
+class DevelopmentConfig(Config):
+    DEVELOPMENT = True
     DEBUG = True
\ No newline at end of file
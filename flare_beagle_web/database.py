@@ -1,2 +1,2 @@
-# from pymongo import Connection
+# from pymongo import Connection
 # import gridfs
\ No newline at end of file